@@ -17,10 +17,15 @@ import util
 import walk
 
 
-DEFAULTS = {'io': {'max_content_length': 67108864,
+DEFAULTS = {'create': {'prefetch_names': False,
+                       'workers': 4},
+            'io': {'max_content_length': 67108864,
                    'server': 'https://devstructure.com'},
+            'processes': {'limit': 8},
             's3': {'region': 'US',
                    'use_https': True},
+            'sources': {'compression': 'none',
+                        'reproducible': False},
             'statsd': {'port': 8125}}
 
 
@@ -64,11 +69,7 @@ class Blueprint(dict):
     def create(cls, name):
         b = cls(name)
         r = rules.defaults()
-        import backend
-        for funcname in backend.__all__:
-            getattr(backend, funcname)(b, r)
-        import services
-        services.services(b)
+        b._create(r)
         return b
 
     @classmethod
@@ -113,11 +114,7 @@ class Blueprint(dict):
     @classmethod
     def rules(cls, r, name=None):
         b = cls(name)
-        import backend
-        for funcname in backend.__all__:
-            getattr(backend, funcname)(b, r)
-        import services
-        services.services(b)
+        b._create(r)
         return b
 
     def __init__(self, name=None, commit=None, *args, **kwargs):
@@ -158,6 +155,56 @@ class Blueprint(dict):
                   service_source=service_source,
                   source=source)
 
+    def _create(self, r):
+        """
+        Run each backend into a blueprint of its own on a pool of threads,
+        since they spend most of their time waiting on subprocesses and the
+        filesystem.  Merge the results into this blueprint in the order of
+        `backend.__all__` so the outcome doesn't depend on which finishes
+        first.  Services are found once every backend has finished.
+        """
+        import backend
+        def create(funcname):
+            b = self.__class__(self.name)
+            getattr(backend, funcname)(b, r)
+            return b
+        with util.parallel_map(len(backend.__all__)) as map_:
+            blueprints = map_(create, backend.__all__)
+        for b in blueprints:
+            self._merge(b)
+        import services
+        services.services(self)
+
+    def _merge(self, other):
+        """
+        Add every resource in another blueprint to this one, as if the
+        backend that found them had added them here in the first place.
+        """
+        for pathname, f in other.get('files', {}).iteritems():
+            self.add_file(pathname, **f)
+        for manager, packages in other.get('packages', {}).iteritems():
+            for package, versions in packages.iteritems():
+                self.packages[manager][package].update(versions)
+        for manager, services in other.get('services', {}).iteritems():
+            for service, deps in services.iteritems():
+                self.add_service(manager, service)
+                self.add_service_file(manager,
+                                      service,
+                                      *deps.get('files', []))
+                for package_manager, packages in \
+                    deps.get('packages', {}).iteritems():
+                    self.add_service_package(manager,
+                                             service,
+                                             package_manager,
+                                             *packages)
+                self.add_service_source(manager,
+                                        service,
+                                        *deps.get('sources', []))
+        for dirname, filename in other.get('sources', {}).iteritems():
+            self.add_source(dirname, filename)
+        if other.get('arch') is not None:
+            self.arch = other['arch']
+
     def __sub__(self, other):
         """
         Subtracting one blueprint from another allows blueprints to remain
@@ -406,9 +453,18 @@ class Blueprint(dict):
         f.close()
         git.git('update-index', '--add', os.path.abspath('blueprint.json'))
 
-        # Add source tarballs to the index.
+        # Add source tarballs to the index.  Those the sources backend found
+        # unchanged since the parent commit are taken from it rather than
+        # written again.
         for filename in self.sources.itervalues():
-            git.git('update-index', '--add', os.path.abspath(filename))
+            blob = None
+            if parent is not None and not os.path.exists(filename):
+                blob = git.blob(git.tree(parent), filename)
+            if blob is None:
+                git.git('update-index', '--add', os.path.abspath(filename))
+            else:
+                git.git('update-index', '--add', '--cacheinfo',
+                        '100644', blob, filename)
 
         # Add `/etc/blueprintignore` and `~/.blueprintignore` to the index.
         # Since adding extra syntax to this file, it no longer makes sense
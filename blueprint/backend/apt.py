@@ -4,8 +4,9 @@ Search for `apt` packages to include in the blueprint.
 
 import os
 import logging
-import subprocess
 
+from blueprint import dpkg
+from blueprint import processes
 from blueprint import util
 
 
@@ -19,8 +20,10 @@ def apt(b, r):
     # multi-arch aware.  If not, revert to old style output_format.
     try:
         with open(os.devnull, 'w') as fnull:
-            rv = subprocess.call(['dpkg', '--print-foreign-architectures'],
-                                    stdout = fnull, stderr = fnull)
+            rv, stdout, stderr = processes.run(
+                ['dpkg', '--print-foreign-architectures'],
+                stdout=fnull,
+                stderr=fnull)
             if rv != 0:
                 output_format = '${Status}\x1E${Package}\x1E${Version}\n'
     except OSError:
@@ -30,29 +33,28 @@ def apt(b, r):
     # bother with the rest because this is probably a Yum/RPM-based
     # system.
     try:
-        p = subprocess.Popen(['dpkg-query','-Wf', output_format],
-                             close_fds=True, stdout=subprocess.PIPE)
+        p = processes.popen(['dpkg-query','-Wf', output_format],
+                            stdout=processes.PIPE)
     except OSError:
         return
 
-    for line in p.stdout:
-        status, package, version = line.strip().split('\x1E')
-        if 'install ok installed' != status:
-            continue
-        if r.ignore_package('apt', package):
-            continue
-
-        b.add_package('apt', package, version)
-
-        # Create service resources for each service init script or config
-        # found in this package.
-        p = subprocess.Popen(['dpkg-query', '-L', package],
-                             close_fds=True, stdout=subprocess.PIPE)
+    with p:
         for line in p.stdout:
-            try:
-                manager, service = util.parse_service(line.rstrip())
-                if not r.ignore_service(manager, service):
-                    b.add_service(manager, service)
-                    b.add_service_package(manager, service, 'apt', package)
-            except ValueError:
-                pass
+            status, package, version = line.strip().split('\x1E')
+            if 'install ok installed' != status:
+                continue
+            if r.ignore_package('apt', package):
+                continue
+
+            b.add_package('apt', package, version)
+
+            # Create service resources for each service init script or config
+            # found in this package.
+            for pathname in dpkg.files(package):
+                try:
+                    manager, service = util.parse_service(pathname)
+                    if not r.ignore_service(manager, service):
+                        b.add_service(manager, service)
+                        b.add_service_package(manager, service, 'apt', package)
+                except ValueError:
+                    pass
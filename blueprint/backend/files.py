@@ -5,19 +5,23 @@ Search for configuration files to include in the blueprint.
 import base64
 from collections import defaultdict
 import errno
-import glob
-import grp
 import hashlib
 import logging
 import os.path
-import pwd
-import re
 import stat
-import subprocess
 
+from blueprint import cache
+from blueprint import cfg
+from blueprint import dpkg
+from blueprint import fs
+from blueprint import rpm
 from blueprint import util
 
 
+# Files are hashed this many bytes at a time so large ones are never held
+# in memory just to be compared to their packaged versions.
+CHUNK_SIZE = 65536
+
 # An extra list of pathnames and MD5 sums that will be checked after no
 # match is found in `dpkg`(1)'s list.  If a pathname is given as the value
 # then that file's contents will be hashed.
@@ -621,37 +625,59 @@ MD5SUMS = {'/etc/adduser.conf': ['/usr/share/adduser/adduser.conf'],
            '/etc/ufw/before6.rules': ['/usr/share/ufw/before6.rules'],
            '/etc/ufw/ufw.conf': ['/usr/share/ufw/ufw.conf']}
 
-for pathname, overrides in MD5SUMS.iteritems():
-    for i in range(len(overrides)):
-        if '/' != overrides[i][0]:
-            continue
-        try:
-            overrides[i] = hashlib.md5(open(overrides[i]).read()).hexdigest()
-        except IOError:
-            pass
-
 
 def files(b, r):
     logging.info('searching for configuration files')
 
+    # Load the digests of files that matched or didn't match their packaged
+    # versions last time.  The verdicts are only good as long as the package
+    # databases and the `MD5SUMS` table above haven't changed.
+    key = cache.packages() + cache.fingerprint(__file__)
+    digests, new_digests = cache.load('files', key) or {}, {}
+
+    # Most of `/etc` is owned by a handful of users and groups.  Where name
+    # lookups are expensive, it may be cheaper still to read every name up
+    # front than to look up even those few.
+    if cfg.getboolean('create', 'prefetch_names'):
+        util.prefetch_names()
+
+    # `lstat` and read files on a pool of threads, which spend most of their
+    # time waiting on the disk.  `map` returns results in order, so the
+    # blueprint is assembled the same way no matter how many workers there
+    # are.  Everything that touches the blueprint or the shared package
+    # database caches stays on this thread.
+    with util.parallel_map() as map_:
+        _files(b, r, map_, digests, new_digests)
+
+    cache.dump('files', key, new_digests)
+
+
+def _files(b, r, map_, digests, new_digests):
+
+    # Entries from `scandir` may still need an `lstat`, which is done on the
+    # pool, but `fs` has already `lstat`ed those it makes itself to tell
+    # directories apart, so sending them through the pool is pure overhead.
+    lstat_map = map if fs.scandir is None else map_
+
     # Visit every file in `/etc` except those on the exclusion list above.
-    for dirpath, dirnames, filenames in os.walk('/etc'):
+    for dirpath, dirs, entries in fs.walk('/etc'):
 
         # Determine if this entire directory should be ignored by default.
         ignored = r.ignore_file(dirpath)
 
+        # Templates are found by name in this directory's listing rather
+        # than by trying to open them for every file.
+        names = set([entry.name for entry in entries])
+
         # Collect up the full pathname to each file, `lstat` them all, and
         # note which ones will probably be ignored.
         files = []
-        for filename in filenames:
-            pathname = os.path.join(dirpath, filename)
-            try:
-                files.append((pathname,
-                              os.lstat(pathname),
-                              r.ignore_file(pathname, ignored)))
-            except OSError as e:
+        for pathname, s in lstat_map(_lstat, entries):
+            if isinstance(s, OSError):
                 logging.warning('{0} caused {1} - try running as root'.
-                                format(pathname, errno.errorcode[e.errno]))
+                                format(pathname, errno.errorcode[s.errno]))
+            else:
+                files.append((pathname, s, r.ignore_file(pathname, ignored)))
 
         # Track the ctime of each file in this directory.  Weed out false
         # positives by ignoring files with common ctimes.
@@ -661,12 +687,16 @@ def files(b, r):
         for pathname, s, ignored in files:
             if not ignored:
                 ctimes[s.st_ctime] += 1
-        for dirname in dirnames:
-            try:
-                ctimes[os.lstat(os.path.join(dirpath, dirname)).st_ctime] += 1
-            except OSError:
-                pass
+        for pathname, s in lstat_map(_lstat, dirs):
+            if not isinstance(s, OSError):
+                ctimes[s.st_ctime] += 1
+
+        # Don't descend into directories that are ignored along with
+        # everything beneath them.
+        dirs[:] = [entry for entry in dirs
+                   if not r.ignore_file_tree(entry.path)]
 
+        candidates = []
         for pathname, s, ignored in files:
 
             # Always ignore block special files, character special files,
@@ -694,43 +724,45 @@ def files(b, r):
             or 1 < ctimes[s.st_ctime] and r.ignore_file(pathname, True):
                 continue
 
-            # Check for a Mustache template and an optional shell script
-            # that templatize this file.
-            try:
-                template = open(
-                    '{0}.blueprint-template.mustache'.format(pathname)).read()
-            except IOError:
-                template = None
-            try:
-                data = open(
-                    '{0}.blueprint-template.sh'.format(pathname)).read()
-            except IOError:
-                data = None
+            # Ignore files that are from the `base-files` package (which
+            # doesn't include MD5 sums for every file for some reason).
+            if 'base-files' in _dpkg_query_S(pathname):
+                continue
 
-            # The content is used even for symbolic links to determine whether
-            # it has changed from the packaged version.
-            try:
-                content = open(pathname).read()
-            except IOError:
-                #logging.warning('{0} not readable'.format(pathname))
+            # Regular files whose `lstat` is the same as last time don't
+            # need to be read again to know they're unchanged from their
+            # packaged version.
+            stat_key, digest = _cached(digests, pathname, s)
+            ignored = r.ignore_file(pathname, True)
+            if digest is not None and digest[2] and ignored:
+                new_digests[pathname] = digest
+                continue
+
+            candidates.append((pathname,
+                               s,
+                               stat_key,
+                               _md5sums(pathname, s),
+                               ignored,
+                               _templates(pathname, names)))
+
+        # Read the remaining files and their templates all at once.
+        contents = map_(_read, candidates)
+        for candidate, c in zip(candidates, contents):
+            pathname, s, stat_key, md5sums, ignored, templates = candidate
+            if c is None:
                 continue
+            template, data, content, md5sum, packaged = c
 
             # Ignore files that are unchanged from their packaged version.
-            if _unchanged(pathname, content, r):
+            if stat_key is not None:
+                new_digests[pathname] = (stat_key, md5sum, packaged)
+            if packaged and ignored:
                 continue
 
             # Resolve the rest of the file's metadata from the
             # `/etc/passwd` and `/etc/group` databases.
-            try:
-                pw = pwd.getpwuid(s.st_uid)
-                owner = pw.pw_name
-            except KeyError:
-                owner = s.st_uid
-            try:
-                gr = grp.getgrgid(s.st_gid)
-                group = gr.gr_name
-            except KeyError:
-                group = s.st_gid
+            owner = util.username(s.st_uid)
+            group = util.groupname(s.st_gid)
             mode = '{0:o}'.format(s.st_mode)
 
             # A symbolic link's content is the link target.
@@ -796,24 +828,136 @@ def files(b, r):
                 pass
 
 
+def _cached(digests, pathname, s):
+    """
+    Return the key a regular file's digest is cached by, made of its
+    inode, size, and modification and change times, and the digest cached
+    for it last time if that key hasn't changed, else `None`.  Both are
+    `None` for anything but a regular file.
+    """
+    if not stat.S_ISREG(s.st_mode):
+        return None, None
+    stat_key = (s.st_ino, s.st_size, s.st_mtime, s.st_ctime)
+    digest = digests.get(pathname)
+    if digest is not None and stat_key != digest[0]:
+        digest = None
+    return stat_key, digest
+
+
+def _lstat(entry):
+    """
+    Return the pathname of a directory entry and its `lstat` or the
+    `OSError` raised trying.
+    """
+    try:
+        return entry.path, entry.stat(follow_symlinks=False)
+    except OSError as e:
+        return entry.path, e
+
+
+def _read(candidate):
+    """
+    Return the Mustache template and shell script that templatize a file,
+    its content, its MD5 sum, and whether it's unchanged from its packaged
+    version or `None` if it can't be read.  The file is hashed as it's read
+    and only the sums that could match are computed.  Its content is only
+    kept if it will be included in the blueprint.
+    """
+    pathname, s, stat_key, md5sums, ignored, templates = candidate
+
+    # Read the Mustache template and optional shell script that templatize
+    # this file if they exist.  The shell script is useless without the
+    # template.
+    template = data = None
+    if templates[0] is not None:
+        try:
+            template = open(templates[0]).read()
+        except IOError:
+            pass
+    if template and templates[1] is not None:
+        try:
+            data = open(templates[1]).read()
+        except IOError:
+            pass
+
+    # The content is used even for symbolic links to determine whether it
+    # has changed from the packaged version.
+    try:
+        f = open(pathname)
+    except IOError:
+        #logging.warning('{0} not readable'.format(pathname))
+        return None
+    try:
+
+        # A regular file without a template will be included in the
+        # blueprint whether or not it's packaged unless it's ignored so it
+        # may as well be read all at once.
+        content = md5sum = None
+        embed = stat.S_ISREG(s.st_mode) and not template
+        if embed and not ignored:
+            content = f.read()
+
+        # Files with nothing to compare against aren't packaged.
+        packaged = False
+        if 0 < len(md5sums):
+            sha256 = 64 in [len(m) for m in md5sums]
+            if content is None:
+                md5sum, sha256sum = _hash(
+                    iter(lambda: f.read(CHUNK_SIZE), ''), sha256)
+            else:
+                md5sum, sha256sum = _hash([content], sha256)
+            packaged = md5sum in md5sums or sha256sum in md5sums
+
+        if embed and content is None and not (packaged and ignored):
+            f.seek(0)
+            content = f.read()
+
+    except IOError:
+        return None
+    finally:
+        f.close()
+
+    return template, data, content, md5sum, packaged
+
+
+def _templates(pathname, names):
+    """
+    Return the pathnames of the Mustache template and shell script that
+    templatize `pathname`, each `None` if it's not among the `names` in
+    its directory.
+    """
+    dirname, filename = os.path.split(pathname)
+    l = []
+    for ext in ('mustache', 'sh'):
+        name = '{0}.blueprint-template.{1}'.format(filename, ext)
+        l.append(os.path.join(dirname, name) if name in names else None)
+    return tuple(l)
+
+
+def _hash(chunks, sha256=False):
+    """
+    Return the MD5 sum and, if asked, the SHA-256 sum (else `None`) of the
+    concatenation of `chunks`.
+    """
+    md5 = hashlib.md5()
+    sha = hashlib.sha256() if sha256 else None
+    for chunk in chunks:
+        md5.update(chunk)
+        if sha is not None:
+            sha.update(chunk)
+    return md5.hexdigest(), sha.hexdigest() if sha is not None else None
+
+
 def _dpkg_query_S(pathname):
     """
     Return a list of package names that contain `pathname` or `[]`.  This
     really can be a list thanks to `dpkg-divert`(1).
     """
 
-    # Cache the pathname-to-package mapping.
-    if not hasattr(_dpkg_query_S, '_cache'):
-        _dpkg_query_S._cache = defaultdict(set)
-        cache_ref = _dpkg_query_S._cache
-        for listname in glob.iglob('/var/lib/dpkg/info/*.list'):
-            package = os.path.splitext(os.path.basename(listname))[0]
-            for line in open(listname):
-                cache_ref[line.rstrip()].add(package)
-
     # Return the list of packages that contain this file, if any.
-    if pathname in _dpkg_query_S._cache:
-        return list(_dpkg_query_S._cache[pathname])
+    packages = dpkg.packages(pathname)
+    if 0 < len(packages):
+        return packages
 
     # If `pathname` isn't in a package but is a symbolic link, see if the
     # symbolic link is in a package.  `postinst` programs commonly display
@@ -832,46 +976,14 @@ def _dpkg_md5sum(package, pathname):
     `pathname` does not come from a Debian package.
     """
 
-    # Cache any MD5 sums stored in the status file.  These are typically
-    # conffiles and the like.
-    if not hasattr(_dpkg_md5sum, '_status_cache'):
-        _dpkg_md5sum._status_cache = {}
-        cache_ref = _dpkg_md5sum._status_cache
-        try:
-            pattern = re.compile(r'^ (\S+) ([0-9a-f]{32})')
-            for line in open('/var/lib/dpkg/status'):
-                match = pattern.match(line)
-                if not match:
-                    continue
-                cache_ref[match.group(1)] = match.group(2)
-        except IOError:
-            pass
-
-    # Return this file's MD5 sum, if it can be found.
-    try:
-        return _dpkg_md5sum._status_cache[pathname]
-    except KeyError:
-        pass
-
-    # Cache the MD5 sums for files in this package.
-    if not hasattr(_dpkg_md5sum, '_cache'):
-        _dpkg_md5sum._cache = defaultdict(dict)
-    if package not in _dpkg_md5sum._cache:
-        cache_ref = _dpkg_md5sum._cache[package]
-        try:
-            for line in open('/var/lib/dpkg/info/{0}.md5sums'.format(package)):
-                md5sum, rel_pathname = line.split(None, 1)
-                cache_ref['/{0}'.format(rel_pathname.rstrip())] = md5sum
-        except IOError:
-            pass
-
-    # Return this file's MD5 sum, if it can be found.
+    # MD5 sums stored in the status file take precedence.  These are
+    # typically conffiles and the like.
     try:
-        return _dpkg_md5sum._cache[package][pathname]
+        return dpkg.conffiles()[pathname]
     except KeyError:
         pass
 
-    return None
+    return dpkg.md5sums(package).get(pathname)
 
 
 def _rpm_qf(pathname):
@@ -880,17 +992,7 @@ def _rpm_qf(pathname):
     might not actually support a single pathname being claimed by more
     than one package but `dpkg` does so the interface is maintained.
     """
-    try:
-        p = subprocess.Popen(['rpm', '--qf=%{NAME}', '-qf', pathname],
-                             close_fds=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    except OSError:
-        return []
-    stdout, stderr = p.communicate()
-    if 0 != p.returncode:
-        return []
-    return [stdout]
+    return rpm.packages(pathname)
 
 
 def _rpm_md5sum(pathname):
@@ -898,74 +1000,49 @@ def _rpm_md5sum(pathname):
     Find the MD5 sum of the packaged version of pathname or `None` if the
     `pathname` does not come from an RPM.
     """
+    return rpm.digest(pathname)
 
-    if not hasattr(_rpm_md5sum, '_cache'):
-        _rpm_md5sum._cache = {}
-        symlinks = []
-        try:
-            p = subprocess.Popen(['rpm', '-qa', '--dump'],
-                                 close_fds=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            pattern = re.compile(r'^(/etc/\S+) \d+ \d+ ([0-9a-f]+) ' # No ,
-                                  '(0\d+) \S+ \S+ \d \d \d (\S+)$')
-            for line in p.stdout:
-                match = pattern.match(line)
-                if match is None:
+
+def _overrides(pathname):
+    """
+    Return the set of MD5 sums given for `pathname` in `MD5SUMS`.  Pathnames
+    given in place of MD5 sums are hashed the first time they're needed
+    rather than every time this module is imported.
+    """
+    if not hasattr(_overrides, '_cache'):
+        _overrides._cache = {}
+    if pathname not in _overrides._cache:
+        md5sums = set()
+        for md5sum in MD5SUMS.get(pathname, []):
+            if '/' == md5sum[0]:
+                try:
+                    f = open(md5sum)
+                    try:
+                        md5sum, _ = _hash(iter(lambda: f.read(CHUNK_SIZE),
+                                               ''))
+                    finally:
+                        f.close()
+                except IOError:
                     continue
-                if '0120777' == match.group(3):
-                    symlinks.append((match.group(1), match.group(4)))
-                else:
-                    _rpm_md5sum._cache[match.group(1)] = match.group(2)
-
-            # Find the MD5 sum of the targets of any symbolic links, even
-            # if the target is outside of /etc.
-            pattern = re.compile(r'^(/\S+) \d+ \d+ ([0-9a-f]+) ' # No ,
-                                  '(0\d+) \S+ \S+ \d \d \d (\S+)$')
-            for pathname, target in symlinks:
-                if '/' != target[0]:
-                    target = os.path.normpath(os.path.join(
-                        os.path.dirname(pathname), target))
-                if target in _rpm_md5sum._cache:
-                    _rpm_md5sum._cache[pathname] = _rpm_md5sum._cache[target]
-                else:
-                    p = subprocess.Popen(['rpm', '-qf', '--dump', target],
-                                         close_fds=True,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-                    for line in p.stdout:
-                        match = pattern.match(line)
-                        if match is not None and target == match.group(1):
-                            _rpm_md5sum._cache[pathname] = match.group(2)
-
-        except OSError:
-            pass
+            md5sums.add(md5sum)
+        _overrides._cache[pathname] = frozenset(md5sums)
+    return _overrides._cache[pathname]
 
-    return _rpm_md5sum._cache.get(pathname, None)
 
-def _unchanged(pathname, content, r):
+def _md5sums(pathname, s):
     """
-    Return `True` if a file is unchanged from its packaged version.
+    Return the set of MD5 (or SHA-256) sums a file with the given `lstat`
+    could have and still match its packaged version or an entry in
+    `MD5SUMS`.  The RPM sum of a regular file is left out when the file's
+    size differs from the packaged version's since it can't possibly match.
     """
-
-    # Ignore files that are from the `base-files` package (which
-    # doesn't include MD5 sums for every file for some reason).
-    apt_packages = _dpkg_query_S(pathname)
-    if 'base-files' in apt_packages:
-        return True
-
-    # Ignore files that are unchanged from their packaged version,
-    # or match in MD5SUMS.
-    md5sums = MD5SUMS.get(pathname, [])
-    md5sums.extend([_dpkg_md5sum(package, pathname)
-                    for package in apt_packages])
-    md5sum = _rpm_md5sum(pathname)
-    if md5sum is not None:
-        md5sums.append(md5sum)
-    if (hashlib.md5(content).hexdigest() in md5sums \
-        or 64 in [len(md5sum or '') for md5sum in md5sums] \
-           and hashlib.sha256(content).hexdigest() in md5sums) \
-       and r.ignore_file(pathname, True):
-        return True
-
-    return False
+    md5sums = set(_overrides(pathname))
+    md5sums.update([_dpkg_md5sum(package, pathname)
+                    for package in _dpkg_query_S(pathname)])
+    rpm_md5sum = _rpm_md5sum(pathname)
+    if rpm_md5sum is not None:
+        if not stat.S_ISREG(s.st_mode) \
+        or rpm.size(pathname) in (None, s.st_size):
+            md5sums.add(rpm_md5sum)
+    md5sums.discard(None)
+    return frozenset(md5sums)
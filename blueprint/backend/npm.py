@@ -7,7 +7,8 @@ Node itself is installed via Chris Lea's PPAs, either
 
 import logging
 import re
-import subprocess
+
+from blueprint import processes
 
 
 def npm(b, r):
@@ -17,15 +18,14 @@ def npm(b, r):
     pattern = re.compile(r'^\S+ (\S+)@(\S+)$')
 
     try:
-        p = subprocess.Popen(['npm', 'ls', '-g'],
-                             close_fds=True,
-                             stdout=subprocess.PIPE)
-        for line in p.stdout:
-            match = pattern.match(line.rstrip())
-            if match is None:
-                continue
-            package, version = match.group(1), match.group(2)
-            if not r.ignore_package('nodejs', package):
-                b.add_package('nodejs', package, version)
+        p = processes.popen(['npm', 'ls', '-g'], stdout=processes.PIPE)
+        with p:
+            for line in p.stdout:
+                match = pattern.match(line.rstrip())
+                if match is None:
+                    continue
+                package, version = match.group(1), match.group(2)
+                if not r.ignore_package('nodejs', package):
+                    b.add_package('nodejs', package, version)
     except OSError:
         pass
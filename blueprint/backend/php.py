@@ -4,8 +4,8 @@ Search for PEAR/PECL packages to include in the blueprint.
 
 import logging
 import re
-import subprocess
 
+from blueprint import processes
 from blueprint import util
 
 
@@ -26,14 +26,14 @@ def php(b, r):
                               (pecl_manager, 'pecl')):
 
         try:
-            p = subprocess.Popen([progname, 'list'],
-                                 close_fds=True, stdout=subprocess.PIPE)
+            p = processes.popen([progname, 'list'], stdout=processes.PIPE)
         except OSError:
             continue
-        for line in p.stdout:
-            match = pattern.match(line)
-            if match is None:
-                continue
-            package, version = match.group(1), match.group(2)
-            if not r.ignore_package(manager, package):
-                b.add_package(manager, package, version)
+        with p:
+            for line in p.stdout:
+                match = pattern.match(line)
+                if match is None:
+                    continue
+                package, version = match.group(1), match.group(2)
+                if not r.ignore_package(manager, package):
+                    b.add_package(manager, package, version)
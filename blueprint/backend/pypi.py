@@ -6,7 +6,10 @@ import glob
 import logging
 import os
 import re
-import subprocess
+
+from blueprint import dpkg
+from blueprint import processes
+from blueprint import rpm
 
 
 # Precompile a pattern to extract the manager from a pathname.
@@ -52,18 +55,12 @@ def pypi(b, r):
                 if os.path.islink(pathname):
                     continue
 
-                # Assume this is a Debian-based system and let `OSError`
-                # looking for `dpkg-query` prove this is RPM-based.  In
-                # that case, the dependencies get a bit simpler.
-                try:
-                    _dpkg_query(b, r,
-                                manager, package, version,
-                                entry, pathname)
-                except OSError:
-                    try:
-                        _rpm(b, r, manager, package, version, entry, pathname)
-                    except OSError:
-                        logging.warning('neither dpkg nor rpm found')
+                # Resolve dependencies as Debian-based systems do if
+                # `dpkg-query` is installed or else as RPM-based systems
+                # do, where they get a bit simpler.
+                resolve = _resolver()
+                if resolve is not None:
+                    resolve(b, r, manager, package, version, entry, pathname)
 
 
 def _dpkg_query(b, r, manager, package, version, entry, pathname):
@@ -73,23 +70,18 @@ def _dpkg_query(b, r, manager, package, version, entry, pathname):
 
     # If this Python package is actually part of a system
     # package, abandon it.
-    p = subprocess.Popen(['dpkg-query', '-S', pathname],
-                         close_fds=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p.communicate()
-    if 0 == p.returncode:
+    if 0 < len(dpkg.packages(pathname)):
         return
 
     # This package was installed via `easy_install`.  Make
     # sure its version of Python is in the blueprint so it
     # can be used as a package manager.
     if pattern_egg.search(entry):
-        p = subprocess.Popen(['dpkg-query', '-f=${Version}', '-W', manager],
-                             close_fds=True,
-                             stdout=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        if 0 != p.returncode:
+        returncode, stdout = _query('dpkg-query',
+                                    '-f=${Version}',
+                                    '-W',
+                                    manager)
+        if 0 != returncode:
             return
         versions = b.packages['apt'][manager]
         if stdout not in versions:
@@ -102,12 +94,8 @@ def _dpkg_query(b, r, manager, package, version, entry, pathname):
     # manager.
     elif pattern_egginfo.search(entry) and os.path.exists(
         os.path.join(pathname, 'installed-files.txt')):
-        p = subprocess.Popen(['dpkg-query', '-W', 'python-pip'],
-                             close_fds=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        p.communicate()
-        if 0 != p.returncode:
+        returncode, stdout = _query('dpkg-query', '-W', 'python-pip')
+        if 0 != returncode:
             if not r.ignore_package('pip', package):
                 b.add_package('pip', package, version)
         else:
@@ -122,26 +110,18 @@ def _rpm(b, r, manager, package, version, entry, pathname):
 
     # If this Python package is actually part of a system
     # package, abandon it.
-    p = subprocess.Popen(['rpm', '-qf', pathname],
-                         close_fds=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p.communicate()
-    if 0 == p.returncode:
+    if 0 < len(rpm.packages(pathname)):
         return
 
     # This package was installed via `easy_install`.  Make
     # sure Python is in the blueprint so it can be used as
     # a package manager.
     if pattern_egg.search(entry):
-        p = subprocess.Popen(['rpm',
-                              '--qf=%{VERSION}-%{RELEASE}.%{ARCH}',
-                              '-q',
-                              'python'],
-                             close_fds=True,
-                             stdout=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        if 0 != p.returncode:
+        returncode, stdout = _query('rpm',
+                                    '--qf=%{VERSION}-%{RELEASE}.%{ARCH}',
+                                    '-q',
+                                    'python')
+        if 0 != returncode:
             return
         versions = b.packages['yum']['python']
         if stdout not in versions:
@@ -154,14 +134,46 @@ def _rpm(b, r, manager, package, version, entry, pathname):
     # manager.
     elif pattern_egginfo.search(entry) and os.path.exists(
         os.path.join(pathname, 'installed-files.txt')):
-        p = subprocess.Popen(['rpm', '-q', 'python-pip'],
-                             close_fds=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        p.communicate()
-        if 0 != p.returncode:
+        returncode, stdout = _query('rpm', '-q', 'python-pip')
+        if 0 != returncode:
             if not r.ignore_package('pip', package):
                 b.add_package('pip', package, version)
         else:
             if not r.ignore_package('python-pip', package):
                 b.add_package('python-pip', package, version)
+
+
+def _resolver():
+    """
+    Return `_dpkg_query` if `dpkg-query` is installed, `_rpm` if `rpm` is,
+    or `None` if neither is.  Each is only looked for once per run.
+    """
+    if not hasattr(_resolver, '_cache'):
+        for args, f in ((('dpkg-query', '--version'), _dpkg_query),
+                        (('rpm', '--version'), _rpm)):
+            try:
+                _query(*args)
+            except OSError:
+                continue
+            _resolver._cache = f
+            break
+        else:
+            logging.warning('neither dpkg nor rpm found')
+            _resolver._cache = None
+    return _resolver._cache
+
+
+def _query(*args):
+    """
+    Return the exit status and standard output of a package manager query.
+    Every package installed by `easy_install` or `pip` asks the same few
+    questions so each is only asked once per run.
+    """
+    if not hasattr(_query, '_cache'):
+        _query._cache = {}
+    if args not in _query._cache:
+        returncode, stdout, stderr = processes.run(list(args),
+                                                   stdout=processes.PIPE,
+                                                   stderr=processes.PIPE)
+        _query._cache[args] = (returncode, stdout)
+    return _query._cache[args]
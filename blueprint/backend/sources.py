@@ -2,26 +2,48 @@
 Search for software built from source to include in the blueprint as a tarball.
 """
 
+import bz2
+from collections import deque
 import errno
 import glob
 import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
 import re
-import shutil
 import stat
-import subprocess
 import tarfile
+import threading
+import zlib
 
-from blueprint import context_managers
+from blueprint import cache
+from blueprint import cfg
+from blueprint import fs
+from blueprint import git
 from blueprint import util
 
 
-def _source(b, r, dirname, old_cwd):
-    tmpname = os.path.join(os.getcwd(), dirname[1:].replace('/', '-'))
+# The size of the blocks compressed tarballs are compressed in.  Each block
+# is compressed independently, as `pigz`(1) does, so several can be
+# compressed at once and the results concatenated.  Both `gzip`(1) and
+# `bzip2`(1) decompress such files as if they'd been compressed whole.
+BLOCK_SIZE = 1 << 20
 
-    exclude = []
+# The extension of tarballs compressed each way.
+EXTENSIONS = {'bzip2': 'tar.bz2',
+              'gzip': 'tar.gz',
+              'none': 'tar'}
+
+
+def _source(b, r, dirname, workers=1):
+    """
+    Archive a directory into a tarball in the current working directory
+    and return its name or `None` if there's nothing worth archiving.  A
+    compressed tarball is compressed on as many threads as `workers`.
+    """
+    exclude = set()
 
     pattern_pip = re.compile(r'\.egg-info/installed-files.txt$')
     pattern_egg = re.compile(r'\.egg(?:-info)?(?:/|$)')
@@ -30,48 +52,34 @@ def _source(b, r, dirname, old_cwd):
     pattern_bin = re.compile(
         r'EASY-INSTALL(?:-ENTRY)?-SCRIPT|This file was generated by RubyGems')
 
-    # Create a partial shallow copy of the directory.
-    for dirpath, dirnames, filenames in os.walk(dirname):
+    # The pathname and `lstat` of each directory and file to be archived,
+    # each directory before its contents.
+    members = []
 
-        # Definitely ignore the shallow copy directory.
-        if dirpath.startswith(tmpname):
-            continue
+    # Directory entries not yet walked, by pathname.  Each directory's
+    # `lstat` comes from the walk of its parent.
+    found = {}
+
+    # Choose what to archive in one walk of the directory.  Nothing is
+    # read but `pip`'s lists of installed files and `/usr/local/bin`.
+    for dirpath, dirs, files in fs.walk(dirname):
+        found.update([(entry.path, entry) for entry in dirs])
 
         # Determine if this entire directory should be ignored by default.
         ignored = r.ignore_file(dirpath)
 
-        dirpath2 = os.path.normpath(
-            os.path.join(tmpname, os.path.relpath(dirpath, dirname)))
-
-        # Create this directory in the shallow copy with matching mode, owner,
-        # and owning group.  Suggest running as `root` if this doesn't work.
-        os.mkdir(dirpath2)
-        s = os.lstat(dirpath)
-        try:
-            try:
-                os.lchown(dirpath2, s.st_uid, s.st_gid)
-            except OverflowError:
-                logging.warning('{0} has uid:gid {1}:{2} - using chown(1)'.
-                                format(dirpath, s.st_uid, s.st_gid))
-                p = subprocess.Popen(['chown',
-                                      '{0}:{1}'.format(s.st_uid, s.st_gid),
-                                      dirpath2],
-                                     close_fds=True)
-                p.communicate()
-            os.chmod(dirpath2, s.st_mode)
-        except OSError as e:
-            logging.warning('{0} caused {1} - try running as root'.
-                            format(dirpath, errno.errorcode[e.errno]))
-            return
+        if dirpath in found:
+            members.append((dirpath,
+                            found.pop(dirpath).stat(follow_symlinks=False)))
+        else:
+            members.append((dirpath, os.lstat(dirpath)))
 
-        for filename in filenames:
-            pathname = os.path.join(dirpath, filename)
+        for entry in files:
+            pathname = entry.path
 
             if r.ignore_source(pathname, ignored):
                 continue
 
-            pathname2 = os.path.join(dirpath2, filename)
-
             # Exclude files that are part of the RubyGems package.
             for globname in (
                 os.path.join('/usr/lib/ruby/gems/*/gems/rubygems-update-*/lib',
@@ -83,12 +91,13 @@ def _source(b, r, dirname, old_cwd):
 
             # Remember the path to all of `pip`'s `installed_files.txt` files.
             if pattern_pip.search(pathname):
-                exclude.extend([os.path.join(dirpath2, line.rstrip())
+                exclude.update([os.path.normpath(os.path.join(dirpath,
+                                                              line.rstrip()))
                     for line in open(pathname)])
 
             # Likewise remember the path to Python eggs.
             if pattern_egg.search(pathname):
-                exclude.append(pathname2)
+                exclude.add(pathname)
 
             # Exclude `easy_install`'s bookkeeping file, too.
             if pattern_pth.search(pathname):
@@ -109,95 +118,324 @@ def _source(b, r, dirname, old_cwd):
             # Clean up dangling symbolic links.  This makes the assumption
             # that no one intends to leave dangling symbolic links hanging
             # around, which I think is a good assumption.
-            s = os.lstat(pathname)
+            s = entry.stat(follow_symlinks=False)
             if stat.S_ISLNK(s.st_mode):
                 try:
-                    os.stat(pathname)
+                    entry.stat()
                 except OSError as e:
                     if errno.ENOENT == e.errno:
                         logging.warning('ignored dangling symbolic link {0}'.
                                         format(pathname))
                         continue
 
-            # Hard link this file into the shallow copy.  Suggest running as
-            # `root` if this doesn't work though in practice the check above
-            # will have already caught this problem.
-            try:
-                os.link(pathname, pathname2)
-            except OSError as e:
-                logging.warning('{0} caused {1} - try running as root'.
-                                format(pathname, errno.errorcode[e.errno]))
-                return
-
-    # Unlink files that were remembered for exclusion above.
-    for pathname in exclude:
-        try:
-            os.unlink(pathname)
-        except OSError as e:
-            if e.errno not in (errno.EISDIR, errno.ENOENT):
-                raise e
-
-    # Remove empty directories.  For any that hang around, match their
-    # access and modification times to the source, otherwise the hash of
-    # the tarball will not be deterministic.
-    for dirpath, dirnames, filenames in os.walk(tmpname, topdown=False):
+            members.append((pathname, s))
+
+    # Drop files that were remembered for exclusion above and then empty
+    # directories.  Walking the members in reverse visits each directory's
+    # contents before the directory itself.
+    nonempty = set()
+    kept = []
+    for pathname, s in reversed(members):
+        if stat.S_ISDIR(s.st_mode):
+            if pathname not in nonempty:
+                continue
+        elif pathname in exclude:
+            continue
+        nonempty.add(os.path.dirname(pathname))
+        kept.append((pathname, s))
+
+    # Archive the members sorted by pathname, which puts each directory
+    # before its contents, so the order doesn't depend on the order the
+    # filesystem lists directories in.
+    kept.sort(key=lambda member: member[0])
+
+    if 0 == len(kept):
+        return None
+    reproducible = cfg.getboolean('sources', 'reproducible')
+    compression = cfg.get('sources', 'compression')
+    if compression not in EXTENSIONS:
+        logging.warning('unknown compression {0} - not compressing'.
+                        format(compression))
+        compression = 'none'
+
+    # If nothing has changed since the last run and the tarball it wrote
+    # was committed to this blueprint as the tarball of this directory, use
+    # it again without reading any of the files.
+    name = 'sources-{0}'.format(hashlib.sha1(dirname).hexdigest())
+    key = _manifest(kept, (dirname, reproducible, compression))
+    cached = cache.load(name, key)
+    if cached is not None:
+        cached_dirname, tarname = cached
+        if dirname == cached_dirname and _committed(b, dirname, tarname):
+            logging.info('{0} is unchanged since {1}'.format(dirname,
+                                                             tarname))
+            return tarname
+
+    # Otherwise write what's left to a tarball named by its SHA1 sum and
+    # include it in the blueprint.  The sum is computed as the tarball is
+    # written rather than by reading it back.
+    tmpname = 'tmp.{0}.{1}.{2}'.format(os.getpid(),
+                                       threading.current_thread().ident,
+                                       EXTENSIONS[compression])
+    f = None
+    try:
         try:
-            os.rmdir(dirpath)
-        except OSError:
-            s = os.lstat(os.path.join(dirname, os.path.relpath(dirpath,
-                                                               tmpname)))
-            os.utime(dirpath, (s.st_atime, s.st_mtime))
-
-    # If the shallow copy of still exists, create a tarball named by its
-    # SHA1 sum and include it in the blueprint.
+            f = _SHA1File(open(tmpname, 'wb'))
+            if 'bzip2' == compression:
+                f = _Compressor(f, bz2.compress, workers)
+            elif 'gzip' == compression:
+                f = _Compressor(f, _gzip, workers)
+            tar = tarfile.open(fileobj=f, mode='w')
+            for pathname, s in kept:
+                arcname = os.path.relpath(pathname, dirname)
+                if '.' != arcname:
+                    arcname = os.path.join('.', arcname)
+                _add(tar, pathname, arcname, s, reproducible)
+            tar.close()
+        finally:
+            if f is not None:
+                f.close()
+    except (IOError, OSError) as e:
+        logging.warning('{0} caused {1} - try running as root'.
+                        format(e.filename or dirname,
+                               errno.errorcode.get(e.errno, e)))
+        if f is not None:
+            os.unlink(tmpname)
+        return None
+
+    # Don't leave a partial tarball behind whatever went wrong.
+    except:
+        if f is not None:
+            os.unlink(tmpname)
+        raise
+    tarname = '{0}.{1}'.format(f.hexdigest(), EXTENSIONS[compression])
+    os.rename(tmpname, tarname)
+    cache.dump(name, key, (dirname, tarname))
+    return tarname
+
+
+def _committed(b, dirname, tarname):
+    """
+    Return `True` if the last commit of the blueprint has the tarball and
+    names it as the tarball of `dirname`.
+    """
+    if b.name is None:
+        return False
+    commit = git.rev_parse('refs/heads/{0}'.format(b.name))
+    if commit is None:
+        return False
+    tree = git.tree(commit)
+    blob = git.blob(tree, 'blueprint.json')
+    if blob is None:
+        return False
     try:
-        tar = tarfile.open('tmp.tar', 'w')
-        tar.add(tmpname, '.')
-    except OSError:
+        sources = json.loads(git.content(blob)).get('sources', {})
+    except (TypeError, ValueError):
+        return False
+    if tarname != sources.get(dirname):
+        return False
+    return git.blob(tree, tarname) is not None
+
+
+def _manifest(members, options):
+    """
+    Return the SHA1 sum of the pathname, size, modification and change
+    times, mode, inode, and owner of every member of a tarball plus the
+    options it's written with.  It changes whenever the tarball would,
+    without reading any of the files.
+    """
+    sha1 = hashlib.sha1(repr(options))
+    for pathname, s in members:
+        sha1.update(repr((pathname,
+                          s.st_size,
+                          s.st_mtime,
+                          s.st_ctime,
+                          s.st_mode,
+                          s.st_dev,
+                          s.st_ino,
+                          s.st_uid,
+                          s.st_gid)))
+    return sha1.hexdigest()
+
+
+def _add(tar, pathname, arcname, s, reproducible=False):
+    """
+    Add `pathname` to `tar` as `tarfile.TarFile.add` would, but using the
+    `lstat` taken while walking and not recursing into directories.  Files
+    tar can't represent, like sockets, are skipped.  If `reproducible` is
+    `True`, the header doesn't record when the file was modified or who
+    owns it, so identical trees on different servers archive identically.
+    """
+    tarinfo = tar.tarinfo()
+    tarinfo.tarfile = tar
+    if stat.S_ISREG(s.st_mode):
+        inode = (s.st_ino, s.st_dev)
+        if 1 < s.st_nlink and inode in tar.inodes:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = tar.inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = s.st_size
+            tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(s.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(s.st_mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(s.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(pathname)
+    elif stat.S_ISCHR(s.st_mode) or stat.S_ISBLK(s.st_mode):
+        tarinfo.type = tarfile.CHRTYPE if stat.S_ISCHR(s.st_mode) \
+                                       else tarfile.BLKTYPE
+        tarinfo.devmajor = os.major(s.st_rdev)
+        tarinfo.devminor = os.minor(s.st_rdev)
+    else:
         return
-    finally:
-        tar.close()
-    sha1 = hashlib.sha1()
-    f = open('tmp.tar', 'r')
-    [sha1.update(buf) for buf in iter(lambda: f.read(4096), '')]
-    f.close()
-    tarname = '{0}.tar'.format(sha1.hexdigest())
-    shutil.move('tmp.tar', os.path.join(old_cwd, tarname))
-    b.add_source(dirname, tarname)
+    tarinfo.name = arcname
+    tarinfo.mode = s.st_mode
+    tarinfo.uid, tarinfo.gid = s.st_uid, s.st_gid
+    tarinfo.mtime = s.st_mtime
+
+    # `util.username` and `util.groupname` fall back to the numeric ID,
+    # which tar only wants when there's no name.
+    if reproducible:
+        tarinfo.mtime = 0
+        tarinfo.uid, tarinfo.gid = 0, 0
+    else:
+        uname, gname = util.username(s.st_uid), util.groupname(s.st_gid)
+        if uname != s.st_uid:
+            tarinfo.uname = uname
+        if gname != s.st_gid:
+            tarinfo.gname = gname
+
+    if tarfile.REGTYPE == tarinfo.type:
+        f = open(pathname, 'rb')
+        try:
+            tar.addfile(tarinfo, f)
+        finally:
+            f.close()
+    else:
+        tar.addfile(tarinfo)
+
+
+def _gzip(s):
+    """
+    Compress `s` as a complete `gzip`(1) member.  The header doesn't record
+    a modification time so equal blocks compress equally.
+    """
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress(s) + z.flush()
 
 
 def sources(b, r):
     logging.info('searching for software built from source')
-    for pathname, negate in r['source']:
-        if negate and os.path.isdir(pathname) \
-        and not r.ignore_source(pathname):
+    dirnames = [pathname for pathname, negate in r['source']
+                if negate and os.path.isdir(pathname)
+                and not r.ignore_source(pathname)]
+
+    # Archive each directory on a pool of threads.  Reading, hashing, and
+    # compressing release the interpreter lock so independent directories,
+    # often on different disks, are archived at the same time.  Threads
+    # rather than processes because this backend is itself running on a
+    # thread and forking then isn't safe.  `map` returns tarballs in the
+    # order of the rules, so the blueprint is the same no matter which
+    # finishes first.  The workers are shared out among the directories to
+    # compress their tarballs so there are never many more threads than
+    # workers in all.
+    share = max(1, cfg.getint('create', 'workers') // max(1, len(dirnames)))
+    with util.parallel_map(len(dirnames)) as map_:
+        tarnames = map_(lambda dirname: _source(b, r, dirname, share),
+                        dirnames)
+    for dirname, tarname in zip(dirnames, tarnames):
+        if tarname is not None:
+            b.add_source(dirname, tarname)
 
-            # Note before creating a working directory within pathname what
-            # it's atime and mtime should be.
-            s = os.lstat(pathname)
+    if 0 < len(b.sources):
+        b.arch = util.arch()
 
-            # Create a working directory within pathname to avoid potential
-            # EXDEV when creating the shallow copy and tarball.
-            try:
-                with context_managers.mkdtemp(pathname) as c:
 
-                    # Restore the parent of the working directory to its
-                    # original atime and mtime, as if pretending the working
-                    # directory never actually existed.
-                    os.utime(pathname, (s.st_atime, s.st_mtime))
+class _Compressor(object):
+    """
+    A file that compresses everything written to it in blocks of
+    `BLOCK_SIZE`, as many at once as there are workers, and writes them
+    in order to another file.
+    """
+
+    def __init__(self, f, compress, workers=1):
+        self._f = f
+        self._compress = compress
+        self._buffer, self._buffered = [], 0
+        self._pending = deque()
+        self._size = 0
+        self._workers = workers
+        if 1 < self._workers:
+            self._pool = ThreadPool(self._workers)
+        else:
+            self._pool = None
+
+    def close(self):
+        try:
+            if 0 < self._buffered:
+                self._submit(''.join(self._buffer))
+            while 0 < len(self._pending):
+                self._f.write(self._pending.popleft().get())
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self._f.close()
+
+    def hexdigest(self):
+        return self._f.hexdigest()
+
+    def tell(self):
+        return self._size
+
+    def write(self, s):
+        self._size += len(s)
+        self._buffer.append(s)
+        self._buffered += len(s)
+        if BLOCK_SIZE > self._buffered:
+            return
+        buffer = ''.join(self._buffer)
+        i = 0
+        while BLOCK_SIZE <= len(buffer) - i:
+            self._submit(buffer[i:i + BLOCK_SIZE])
+            i += BLOCK_SIZE
+        self._buffer, self._buffered = [buffer[i:]], len(buffer) - i
+
+    def _submit(self, block):
+        """
+        Compress a block, in the background if there are workers.  Blocks
+        are written as they're finished, in order, and no more than twice
+        as many as there are workers are kept waiting.
+        """
+        if self._pool is None:
+            self._f.write(self._compress(block))
+            return
+        self._pending.append(self._pool.apply_async(self._compress, (block,)))
+        while 2 * self._workers < len(self._pending):
+            self._f.write(self._pending.popleft().get())
 
-                    # Create the shallow copy and possibly tarball of the
-                    # relevant parts of pathname.
-                    _source(b, r, pathname, c.cwd)
 
-                # Once more restore the atime and mtime after the working
-                # directory is destroyed.
-                os.utime(pathname, (s.st_atime, s.st_mtime))
+class _SHA1File(object):
+    """
+    A file that computes the SHA1 sum of everything written to it.
+    """
 
-            # If creating the temporary directory fails, bail with a warning.
-            except OSError as e:
-                logging.warning('{0} caused {1} - try running as root'.
-                                format(pathname, errno.errorcode[e.errno]))
+    def __init__(self, f):
+        self._f = f
+        self._sha1 = hashlib.sha1()
 
-    if 0 < len(b.sources):
-        b.arch = util.arch()
+    def close(self):
+        self._f.close()
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+    def tell(self):
+        return self._f.tell()
+
+    def write(self, s):
+        self._sha1.update(s)
+        self._f.write(s)
@@ -3,28 +3,18 @@ Search for `yum` packages to include in the blueprint.
 """
 
 import logging
-import subprocess
 
+from blueprint import rpm
 from blueprint import util
 
 
 def yum(b, r):
     logging.info('searching for Yum packages')
 
-    # Try for the full list of packages.  If this fails, don't even
+    # Read the full list of packages.  If there is none, don't even
     # bother with the rest because this is probably a Debian-based
     # system.
-    try:
-        p = subprocess.Popen(['rpm',
-                              '--qf=%{NAME}\x1E%{GROUP}\x1E%{EPOCH}' # No ,
-                              '\x1E%{VERSION}-%{RELEASE}\x1E%{ARCH}\n',
-                              '-qa'],
-                             close_fds=True, stdout=subprocess.PIPE)
-    except OSError:
-        return
-
-    for line in p.stdout:
-        package, group, epoch, version, arch = line.strip().split('\x1E')
+    for package, group, epoch, version, arch in rpm.installed():
         if r.ignore_package('yum', package):
             continue
 
@@ -36,11 +26,9 @@ def yum(b, r):
 
         # Create service resources for each service init script or config
         # in this package.
-        p = subprocess.Popen(['rpm', '-ql', package],
-                             close_fds=True, stdout=subprocess.PIPE)
-        for line in p.stdout:
+        for pathname in rpm.files(package):
             try:
-                manager, service = util.parse_service(line.rstrip())
+                manager, service = util.parse_service(pathname)
                 if not r.ignore_service(manager, service):
                     b.add_service(manager, service)
                     b.add_service_package(manager, service, 'yum', package)
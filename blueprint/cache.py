@@ -0,0 +1,165 @@
+"""
+Cache expensive results between runs.  Each cache is stored alongside a
+key, typically the fingerprint of the files it was computed from, and is
+only returned if the key still matches when it's loaded.  Caches live in a
+directory named for `VERSION`, which must be incremented whenever the
+format of any cache changes, within `~/.blueprint-cache`.
+
+Caches decide what's left out of a blueprint so they're only trusted in a
+directory no one else could have written to: a real directory owned by
+the user running Blueprint, or the user who invoked it via `sudo`(8),
+with mode 0700.  Otherwise nothing is cached.
+
+Caches are serialized with `marshal` rather than `pickle` so loading one
+never instantiates arbitrary objects.  Each is prefixed by the SHA-1 sum
+of the rest so a corrupt cache is recomputed rather than trusted.
+"""
+
+import errno
+import hashlib
+import marshal
+import os
+import os.path
+import stat
+import threading
+
+from blueprint import fixtures
+from blueprint import util
+
+
+VERSION = 3
+
+def fingerprint(*pathnames):
+    """
+    Return a tuple that changes whenever any of the given files change,
+    made of each file's pathname, modification time, and size.
+    """
+    l = []
+    for pathname in pathnames:
+        try:
+            s = os.stat(pathname)
+            l.append((pathname, s.st_mtime, s.st_size))
+        except OSError:
+            l.append((pathname, 0, 0))
+    return tuple(l)
+
+
+def packages():
+    """
+    Return the fingerprint of the dpkg and RPM databases, which change
+    whenever packages are installed or removed.  Both modules use this
+    one, so they're imported here rather than at the top.
+    """
+    from blueprint import dpkg
+    from blueprint import rpm
+    return fingerprint(dpkg.STATUS, *rpm.DATABASES)
+
+
+def load(name, key):
+    """
+    Return the value cached by the given name or `None` if it doesn't exist,
+    can't be read, or was stored with a different key.  Nothing is cached
+    while recording or replaying a fixture bundle.
+    """
+    if fixtures.active() or not _trusted():
+        return None
+    try:
+        f = open(_pathname(name), 'rb')
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        if hashlib.sha1(content[20:]).digest() != content[0:20]:
+            return None
+        cached_key, value = marshal.loads(content[20:])
+    except (IOError, EOFError, TypeError, ValueError):
+        return None
+    if cached_key != key:
+        return None
+    return value
+
+
+def dump(name, key, value):
+    """
+    Cache a value by the given name and key.  The cache file is replaced
+    atomically so concurrent readers never see a partial write.  Failure
+    to write the cache is not an error.
+    """
+    if fixtures.active():
+        return
+    pathname = _pathname(name)
+    tmpname = '{0}.{1}.{2}'.format(pathname,
+                                   os.getpid(),
+                                   threading.current_thread().ident)
+    try:
+        _mkdir(_dirname())
+        _mkdir(os.path.dirname(pathname))
+        if not _trusted():
+            return
+        f = open(tmpname, 'wb')
+        try:
+            _chown(f)
+            content = marshal.dumps((key, value))
+            f.write(hashlib.sha1(content).digest())
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmpname, pathname)
+    except (IOError, OSError, ValueError):
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+
+
+def _chown(f):
+    if util.via_sudo():
+        uid = int(os.environ['SUDO_UID'])
+        gid = int(os.environ['SUDO_GID'])
+        os.fchown(f.fileno(), uid, gid)
+
+
+def _dirname():
+    """
+    Return the full path to the cache directory.
+    """
+    return os.path.expanduser('~/.blueprint-cache')
+
+
+def _pathname(name):
+    return os.path.join(_dirname(), str(VERSION), name)
+
+
+def _mkdir(dirname):
+    try:
+        os.mkdir(dirname, 0700)
+    except OSError as e:
+        if errno.EEXIST != e.errno:
+            raise
+        return
+    if util.via_sudo():
+        uid = int(os.environ['SUDO_UID'])
+        gid = int(os.environ['SUDO_GID'])
+        os.chown(dirname, uid, gid)
+
+
+def _trusted():
+    """
+    Return `True` if the cache directory and the directory for `VERSION`
+    within it are real directories owned by this user, or by the user who
+    invoked Blueprint via `sudo`(8) since they're handed over to that user,
+    and writable by no one else.
+    """
+    uids = set([os.geteuid()])
+    if util.via_sudo():
+        uids.add(int(os.environ['SUDO_UID']))
+    for dirname in (_dirname(), os.path.join(_dirname(), str(VERSION))):
+        try:
+            s = os.lstat(dirname)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(s.st_mode) \
+        or s.st_uid not in uids \
+        or 0 != stat.S_IMODE(s.st_mode) & 0077:
+            return False
+    return True
@@ -1,104 +1,98 @@
 import logging
-import re
-import subprocess
+import threading
+
+from blueprint import cache
+from blueprint import dpkg
+from blueprint import rpm
+
+
+# Guards loading each manager's closures and remembering new ones.
+_lock = threading.Lock()
 
 
 def apt(s):
     """
     Walk the dependency tree of all the packages in set s all the way to
-    the leaves.  Return the set of s plus all their dependencies.
+    the leaves.  Return the set of s plus all their dependencies.  The
+    tree is read from the dpkg status file once.
     """
     logging.debug('searching for APT dependencies')
-    if not isinstance(s, set):
-        s = set([s])
-    tmp_s = s
-    pattern_sub = re.compile(r'\([^)]+\)')
-    pattern_split = re.compile(r'[,\|]')
-    while 1:
-        new_s = set()
-        for package in tmp_s:
-            p = subprocess.Popen(
-                ['dpkg-query',
-                 '-f', '${Pre-Depends}\n${Depends}\n${Recommends}\n',
-                 '-W', package],
-                close_fds=True, stdout=subprocess.PIPE)
-            for line in p.stdout:
-                line = line.strip()
-                if '' == line:
-                    continue
-                for part in pattern_split.split(pattern_sub.sub('', line)):
-                    new_s.add(part.strip())
-
-        # If there is to be a next iteration, `new_s` must contain some
-        # packages not yet in `s`.
-        tmp_s = new_s - s
-        if 0 == len(tmp_s):
-            break
-        s |= new_s
-
-    return s
+    return _walk(apt, s, dpkg.depends, 'apt-closures',
+                 cache.fingerprint(__file__, dpkg.__file__, dpkg.STATUS))
 
 
 def yum(s):
     """
     Walk the dependency tree of all the packages in set s all the way to
-    the leaves.  Return the set of s plus all their dependencies.
+    the leaves.  Return the set of s plus all their dependencies.  The
+    tree is read from one query of the RPM database.
     """
     logging.debug('searching for Yum dependencies')
+    return _walk(yum, s, rpm.depends, 'yum-closures',
+                 cache.fingerprint(__file__, rpm.__file__, *rpm.DATABASES))
+
+
+def dump():
+    """
+    Cache on disk the closures computed since they were loaded.  This is
+    done once, after the rules that need them are built, rather than every
+    time one is computed.
+    """
+    dumps = []
+    with _lock:
+        for f in (apt, yum):
+            if getattr(f, '_dirty', False):
+                dumps.append((f._name, f._key, dict(f._cache)))
+                f._dirty = False
+    for name, key, closures in dumps:
+        cache.dump(name, key, closures)
 
-    if not hasattr(yum, '_cache'):
-        yum._cache = {}
-        try:
-            p = subprocess.Popen(['rpm',
-                                  '-qa',
-                                  '--qf=%{NAME}\x1E[%{PROVIDES}\x1F]\n'],
-                                 close_fds=True,
-                                 stdout=subprocess.PIPE)
-            for line in p.stdout:
-                name, caps = line.rstrip().split('\x1E')
-                yum._cache.update([(cap, name) for cap in caps.split('\x1F')])
-        except OSError:
-            pass
 
+def _walk(f, s, depends, name, key):
+    """
+    Walk the dependency tree given by the `depends` function from the
+    packages in set s.  The closure of each package is remembered on `f`
+    for the rest of the run, so rules sharing dependencies share the work,
+    and loaded from the cache by `name` until `key`, the fingerprint of
+    the package database, changes.
+    """
     if not isinstance(s, set):
         s = set([s])
 
-    tmp_s = s
-    while 1:
-        new_s = set()
-        for package in tmp_s:
-            try:
-                p = subprocess.Popen(['rpm', '-qR', package],
-                                     close_fds=True,
-                                     stdout=subprocess.PIPE)
-            except OSError:
-                continue
-            for line in p.stdout:
-                cap = line.rstrip()[0:line.find(' ')]
-                if 'rpmlib' == cap[0:6]:
-                    continue
-                try:
-                    new_s.add(yum._cache[cap])
-                except KeyError:
-                    try:
-                        p2 = subprocess.Popen(['rpm',
-                                               '-q',
-                                               '--qf=%{NAME}',
-                                               '--whatprovides',
-                                               cap],
-                                              close_fds=True,
-                                              stdout=subprocess.PIPE)
-                        stdout, stderr = p2.communicate()
-                        yum._cache[cap] = stdout
-                        new_s.add(stdout)
-                    except OSError:
-                        pass
-
-        # If there is to be a next iteration, `new_s` must contain some
-        # packages not yet in `s`.
-        tmp_s = new_s - s
-        if 0 == len(tmp_s):
-            break
-        s |= new_s
-
-    return s
+    with _lock:
+        if not hasattr(f, '_cache'):
+            f._cache = cache.load(name, key) or {}
+            f._name, f._key, f._dirty = name, key, False
+
+    closure = set()
+    for package in s:
+        closure |= _closure(f, package, depends)
+    return closure
+
+
+def _closure(f, package, depends):
+    """
+    Return the set of `package` and every package it depends on, however
+    indirectly.  The walk stops at packages whose closure is already known.
+    """
+    try:
+        return f._cache[package]
+    except KeyError:
+        pass
+
+    s, todo = set([package]), [package]
+    while 0 < len(todo):
+        known = f._cache.get(todo[-1])
+        if known is not None:
+            todo.pop()
+            s |= known
+            continue
+        for dep in depends(todo.pop()):
+            if dep not in s:
+                s.add(dep)
+                todo.append(dep)
+
+    with _lock:
+        f._cache[package] = frozenset(s)
+        f._dirty = True
+    return f._cache[package]
@@ -0,0 +1,222 @@
+"""
+Query the dpkg database directly rather than forking `dpkg-query`(1) once
+per package or pathname.
+"""
+
+from collections import defaultdict
+import glob
+import logging
+import os.path
+import re
+import threading
+
+from blueprint import cache
+from blueprint import fixtures
+
+
+INFO = '/var/lib/dpkg/info'
+STATUS = '/var/lib/dpkg/status'
+
+# Guards the caches of `conffiles`, `md5sums`, `_index`, and `_graph`,
+# which are filled by whichever thread first asks for them.
+_lock = threading.Lock()
+
+
+# Patterns for removing version constraints from and splitting apart the
+# package relationship fields.
+pattern_sub = re.compile(r'\([^)]+\)')
+pattern_split = re.compile(r'[,\|]')
+
+# Pattern for a pathname and MD5 sum in the Conffiles field.
+pattern_conffile = re.compile(r'^ (\S+) ([0-9a-f]{32})')
+
+
+def conffiles():
+    """
+    Return a map of each conffile pathname to the MD5 sum of its packaged
+    version, as recorded in the dpkg status file.
+    """
+    if hasattr(conffiles, '_cache'):
+        return conffiles._cache
+    with _lock:
+        if not hasattr(conffiles, '_cache'):
+            d = {}
+            for fields in status():
+                for line in fields.get('Conffiles', '').splitlines():
+                    match = pattern_conffile.match(line)
+                    if match:
+                        d[match.group(1)] = match.group(2)
+            conffiles._cache = d
+    return conffiles._cache
+
+
+def depends(package):
+    """
+    Return the set of packages named by the Pre-Depends, Depends, and
+    Recommends fields of `package`, as `dpkg-query -W` would report them.
+    Every alternative is included.  Unqualified names cover all installed
+    architectures of a package.
+    """
+    return _graph().get(package, frozenset())
+
+
+def files(package):
+    """
+    Return the list of pathnames installed by `package`, as
+    `dpkg-query -L` would, or `[]` if it isn't installed.  Packages
+    installed for more than one architecture list the files of each.
+    """
+    return _index()[0].get(package, [])
+
+
+def md5sums(package):
+    """
+    Return a map of each pathname in `package` to the MD5 sum of its
+    packaged version, as recorded in `/var/lib/dpkg/info/*.md5sums`.
+    `Multi-Arch: same` packages keep a list per architecture, named
+    `package:arch.md5sums`, which are all read.  Each package's lists are
+    read at most once per run.
+    """
+    with _lock:
+        if not hasattr(md5sums, '_cache'):
+            md5sums._cache = {}
+        if package not in md5sums._cache:
+            md5sums._cache[package] = _read_md5sums(package)
+        return md5sums._cache[package]
+
+
+def _read_md5sums(package):
+    d = {}
+    basenames = ['{0}.md5sums'.format(package)] + [
+        os.path.basename(md5sumsname) for md5sumsname in glob.iglob(
+            os.path.join(fixtures.fixture_pathname(INFO),
+                         '{0}:*.md5sums'.format(package)))]
+    for basename in basenames:
+        try:
+            for line in fixtures.open_fixture(os.path.join(INFO, basename)):
+                md5sum, rel_pathname = line.split(None, 1)
+                d['/{0}'.format(rel_pathname.rstrip())] = md5sum
+        except IOError:
+            pass
+    return d
+
+
+def packages(pathname):
+    """
+    Return the list of packages that contain `pathname`, as `dpkg-query -S`
+    would, or `[]`.  This really can be a list thanks to `dpkg-divert`(1).
+    """
+    return list(_index()[1].get(pathname, []))
+
+
+def _index():
+    """
+    Build the package-to-pathnames and pathname-to-packages maps from
+    `/var/lib/dpkg/info/*.list` once per run.  The former is cached on disk
+    until a package is installed or removed.
+
+    `Multi-Arch: same` packages keep a list per architecture, named
+    `package:arch.list`.  They're indexed by the package's name alone, as
+    the APT backend and services know them, with every architecture's
+    files merged.
+    """
+    if hasattr(_index, '_cache'):
+        return _index._cache
+    with _lock:
+        if not hasattr(_index, '_cache'):
+            _index._cache = _build_index()
+    return _index._cache
+
+
+def _build_index():
+    key = cache.fingerprint(STATUS, INFO, __file__)
+    package_files = cache.load('dpkg-files', key)
+    if package_files is None:
+        logging.info('indexing dpkg files')
+        package_files = {}
+        for listname in sorted(glob.iglob(
+            os.path.join(fixtures.fixture_pathname(INFO), '*.list'))):
+            listname = os.path.basename(listname)
+            package = os.path.splitext(listname)[0].partition(':')[0]
+            try:
+                pathnames = [line.rstrip() for line in
+                    fixtures.open_fixture(os.path.join(INFO, listname))]
+            except IOError:
+                continue
+            existing = package_files.setdefault(package, [])
+            seen = set(existing)
+            existing.extend([pathname for pathname in pathnames
+                             if pathname not in seen])
+        cache.dump('dpkg-files', key, package_files)
+
+    pathname_packages = defaultdict(set)
+    for package, pathnames in package_files.iteritems():
+        for pathname in pathnames:
+            pathname_packages[pathname].add(package)
+
+    return package_files, pathname_packages
+
+
+def status():
+    """
+    Generate a `dict` of the fields in each stanza of the dpkg status file.
+    Continuation lines are joined to their field by newlines.
+    """
+    try:
+        f = fixtures.open_fixture(STATUS)
+    except IOError:
+        return
+    fields, name = {}, None
+    for line in f:
+        line = line.rstrip('\n')
+        if '' == line:
+            if 0 < len(fields):
+                yield fields
+            fields, name = {}, None
+        elif line[0] in ' \t':
+            if name is not None:
+                fields[name] += '\n' + line
+        else:
+            name, _, value = line.partition(':')
+            fields[name] = value.strip()
+    f.close()
+    if 0 < len(fields):
+        yield fields
+
+
+def _graph():
+    """
+    Parse the dpkg status file once per run into a map of each package to
+    the packages it depends on.
+    """
+    if hasattr(_graph, '_cache'):
+        return _graph._cache
+    with _lock:
+        if not hasattr(_graph, '_cache'):
+            _graph._cache = _build_graph()
+    return _graph._cache
+
+
+def _build_graph():
+    graph = defaultdict(set)
+    for fields in status():
+        try:
+            names = [fields['Package'], '{0}:{1}'.format(
+                fields['Package'], fields.get('Architecture'))]
+        except KeyError:
+            continue
+
+        # Packages without dependencies must still be known.
+        graph[names[0]]
+        graph[names[1]]
+
+        for field in ('Pre-Depends', 'Depends', 'Recommends'):
+            for line in fields.get(field, '').splitlines():
+                line = line.strip()
+                if '' == line:
+                    continue
+                for part in pattern_split.split(pattern_sub.sub('', line)):
+                    for name in names:
+                        graph[name].add(part.strip())
+    return dict([(package, frozenset(deps))
+                 for package, deps in graph.iteritems()])
@@ -0,0 +1,192 @@
+"""
+Record the commands Blueprint runs to inspect a server and the package
+databases it reads into a fixture bundle, or replay a bundle in their
+place.  Replaying a bundle recorded elsewhere lets `blueprint-create`(1)
+be profiled and regression-tested against that server without access
+to it.  Recorded commands are kept in memory and written to the bundle
+once, when Blueprint exits.
+
+A bundle is a directory.  `commands` within it maps the arguments of each
+command to its exit status and standard output and `files` within it holds
+copies of the database files, each at its original pathname.  Commands
+other than those in `COMMANDS`, for example `git`(1), are never recorded
+or replayed.
+"""
+
+import atexit
+import errno
+import logging
+import marshal
+import os
+import os.path
+import shutil
+import threading
+
+
+# Commands that only inspect the server and so may be recorded and
+# replayed.
+COMMANDS = ('dpkg',
+            'dpkg-query',
+            'lsb_release',
+            'npm',
+            'pear',
+            'pecl',
+            'rpm',
+            'yum')
+
+# The mode, `'record'` or `'replay'`, and the bundle's directory.
+_mode = None
+_dirname = None
+
+# The recorded commands, loaded from the bundle or kept in memory until
+# they're written to it at exit.
+_commands = {}
+
+# Guards `_commands` and the copying of files into the bundle.
+_lock = threading.Lock()
+
+
+def active():
+    """
+    Return `True` if a bundle is being recorded or replayed.  Caches are
+    neither loaded nor stored then so every command runs and a replay
+    depends on nothing but its bundle.
+    """
+    return _mode is not None
+
+
+def fixture_pathname(pathname):
+    """
+    Return the pathname where a database file or directory can be found,
+    which is in the bundle if replaying.  Files aren't copied into a bundle
+    being recorded until they're opened with `open_fixture`.
+    """
+    if 'replay' == _mode:
+        return os.path.join(_dirname, 'files', pathname.lstrip('/'))
+    return pathname
+
+
+def open_fixture(pathname):
+    """
+    Open a database file, as recorded if replaying.
+    """
+    return open(_pathname(pathname))
+
+
+def record(args, returncode, stdout):
+    """
+    Record the exit status and standard output of the command given by
+    `args` if a bundle is being recorded.  An exit status of `None` means
+    the command wasn't found.
+    """
+    if 'record' != _mode:
+        return
+    with _lock:
+        _commands[tuple(args)] = (returncode, stdout)
+
+
+def records(name):
+    """
+    Return `True` if the command named `name` is being recorded.
+    """
+    return 'record' == _mode and name in COMMANDS
+
+
+def replay(args):
+    """
+    Return the recorded exit status and standard output of the command
+    given by `args`.  Raise `OSError` if it wasn't found when the bundle
+    was recorded or wasn't recorded at all, as if it weren't installed.
+    """
+    try:
+        returncode, stdout = _commands[tuple(args)]
+    except KeyError:
+        logging.warning('{0} was not recorded'.format(' '.join(args)))
+        returncode = None
+    if returncode is None:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+    return returncode, stdout
+
+
+def replays(name):
+    """
+    Return `True` if the command named `name` is being replayed.
+    """
+    return 'replay' == _mode and name in COMMANDS
+
+
+def start_recording(dirname):
+    """
+    Start recording a bundle into `dirname`.  The recorded commands are
+    written once, at exit, but an empty bundle is written now so a
+    directory that can't be written to is noticed right away.
+    """
+    global _mode, _dirname
+    _mode, _dirname = 'record', dirname
+    _commands.clear()
+    _mkdir(os.path.join(dirname, 'files'))
+    _write()
+    atexit.register(_write)
+
+
+def start_replaying(dirname):
+    """
+    Start replaying the bundle in `dirname`.
+    """
+    global _mode, _dirname
+    f = open(os.path.join(dirname, 'commands'), 'rb')
+    try:
+        commands = marshal.load(f)
+    finally:
+        f.close()
+    _mode, _dirname = 'replay', dirname
+    _commands.clear()
+    _commands.update(commands)
+
+
+def _mkdir(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if errno.EEXIST != e.errno:
+            raise
+
+
+def _pathname(pathname):
+    """
+    Return the pathname to open for a database file, first copying it into
+    the bundle if recording.  Files that can't be read aren't copied so
+    they can't be read when replaying, either.
+    """
+    if 'record' == _mode:
+        copyname = os.path.join(_dirname, 'files', pathname.lstrip('/'))
+        with _lock:
+            if not os.path.exists(copyname):
+                try:
+                    _mkdir(os.path.dirname(copyname))
+                    shutil.copy2(pathname, copyname)
+                except (IOError, OSError):
+                    pass
+        return pathname
+    if 'replay' == _mode:
+        return os.path.join(_dirname, 'files', pathname.lstrip('/'))
+    return pathname
+
+
+def _write():
+    """
+    Write the recorded commands into the bundle if one is still being
+    recorded.  The file is replaced atomically so it's never left
+    half-written.
+    """
+    if 'record' != _mode:
+        return
+    pathname = os.path.join(_dirname, 'commands')
+    tmpname = '{0}.{1}'.format(pathname, os.getpid())
+    with _lock:
+        f = open(tmpname, 'wb')
+        try:
+            marshal.dump(_commands, f)
+        finally:
+            f.close()
+        os.rename(tmpname, pathname)
@@ -45,7 +45,8 @@ def chef(b, relaxed=False):
                       cwd=dirname)
         else:
             c.execute('{0}'.format(pathname),
-                      command='tar xf "{0}"'.format(pathname),
+                      command='tar x{0}f "{1}"'.format(
+                          util.tar_compression(pathname), pathname),
                       cwd=dirname)
 
     def file(pathname, f):
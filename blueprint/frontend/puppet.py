@@ -51,7 +51,9 @@ def puppet(b, relaxed=False):
                                   alias=dirname,
                                   cwd=dirname))
         else:
-            m['sources'].add(Exec('tar xf {0}'.format(pathname),
+            m['sources'].add(Exec('tar x{0}f {1}'.format(
+                                      util.tar_compression(pathname),
+                                      pathname),
                                   alias=dirname,
                                   cwd=dirname))
 
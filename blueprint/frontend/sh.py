@@ -54,15 +54,18 @@ def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
             if '.zip' == pathname[-4:]:
                 s.add('unzip "{0}" -d "{1}"', args=(filename, dirname))
             else:
-                s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
+                s.add('mkdir -p "{1}" && tar x{2}f "{0}" -C "{1}"',
+                      args=(filename, dirname, util.tar_compression(filename)))
         elif secret is not None:
             s.add_list(('curl -O "{0}/{1}/{2}/{3}"',),
                        ('wget "{0}/{1}/{2}/{3}"',),
                        args=(server, secret, b.name, filename),
                        operator='||')
-            s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
+            s.add('mkdir -p "{1}" && tar x{2}f "{0}" -C "{1}"',
+                  args=(filename, dirname, util.tar_compression(filename)))
         elif gen_content is not None:
-            s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
+            s.add('mkdir -p "{1}" && tar x{2}f "{0}" -C "{1}"',
+                  args=(filename, dirname, util.tar_compression(filename)))
             s.add_source(filename, git.blob(tree, filename))
         for manager, service in lut['sources'][dirname]:
             s.add_list(('[ "$MD5SUM" != "$(find "{0}" -printf %T@\\\\n '
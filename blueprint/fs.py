@@ -0,0 +1,85 @@
+"""
+Walk directory trees like `os.walk` but yield directory entries that
+remember their `lstat` so no inode is `stat`ed more than once.  Entries
+come from `os.scandir` or the `scandir` module, which usually know whether
+an entry is a directory without a `stat` at all, and from `os.listdir`
+otherwise.
+"""
+
+import os
+import os.path
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def walk(top):
+    """
+    Generate a `(dirpath, dirs, files)` tuple for each directory in the tree
+    rooted at `top`, where `dirs` and `files` are lists of entries with
+    `name` and `path` attributes and `is_dir`, `is_symlink`, and `stat`
+    methods.  As with `os.walk`, symbolic links to directories are listed
+    in `dirs` but not followed, unreadable directories are skipped, and
+    removing entries from `dirs` prevents walking them.
+    """
+    try:
+        entries = list(_scandir(top))
+    except OSError:
+        return
+    dirs, files = [], []
+    for entry in entries:
+        if entry.is_dir():
+            dirs.append(entry)
+        else:
+            files.append(entry)
+    yield top, dirs, files
+    for entry in dirs:
+        if not entry.is_symlink():
+            for t in walk(entry.path):
+                yield t
+
+
+def _scandir(dirname):
+    if scandir is not None:
+        return scandir(dirname)
+    return [_Entry(dirname, name) for name in os.listdir(dirname)]
+
+
+class _Entry(object):
+    """
+    A stand-in for the entries `scandir` returns.  The `lstat` needed to
+    tell whether an entry is a directory is kept for later.
+    """
+
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._lstat = None
+        self._stat = None
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
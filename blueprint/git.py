@@ -1,9 +1,9 @@
 import logging
 import os
 import os.path
-import subprocess
 import sys
 
+from blueprint import processes
 from blueprint import util
 
 
@@ -38,22 +38,20 @@ def init():
     except OSError:
         pass
     try:
-        p = subprocess.Popen(['git',
-                              '--git-dir', dirname,
-                              'init',
-                              '--bare',
-                              '-q'],
-                             close_fds=True,
-                             preexec_fn=unroot,
-                             stdout=sys.stderr,
-                             stderr=sys.stderr)
+        returncode, stdout, stderr = processes.run(['git',
+                                                    '--git-dir', dirname,
+                                                    'init',
+                                                    '--bare',
+                                                    '-q'],
+                                                   preexec_fn=unroot,
+                                                   stdout=sys.stderr,
+                                                   stderr=sys.stderr)
     except OSError:
         logging.error('git not found on PATH - exiting')
         sys.exit(1)
-    p.communicate()
-    if 0 != p.returncode:
-        #sys.exit(p.returncode)
-        raise GitError(p.returncode)
+    if 0 != returncode:
+        #sys.exit(returncode)
+        raise GitError(returncode)
 
 
 def git_args():
@@ -70,18 +68,17 @@ def git(*args, **kwargs):
     raise_exc keyword argument is falsey.
     """
     try:
-        p = subprocess.Popen(git_args() + list(args),
-                             close_fds=True,
-                             preexec_fn=unroot,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE)
+        returncode, stdout, stderr = processes.run(git_args() + list(args),
+                                                   kwargs.get('stdin'),
+                                                   preexec_fn=unroot,
+                                                   stdin=processes.PIPE,
+                                                   stdout=processes.PIPE)
     except OSError:
         logging.error('git not found on PATH - exiting')
         sys.exit(1)
-    stdout, stderr = p.communicate(kwargs.get('stdin'))
-    if 0 != p.returncode and kwargs.get('raise_exc', True):
-        raise GitError(p.returncode)
-    return p.returncode, stdout
+    if 0 != returncode and kwargs.get('raise_exc', True):
+        raise GitError(returncode)
+    return returncode, stdout
 
 
 def repo():
@@ -154,15 +151,11 @@ def cat_file(blob, pathname=None):
     """
     args = git_args() + ['cat-file', 'blob', blob]
     if pathname is None:
-        return subprocess.Popen(args,
-                                close_fds=True,
-                                preexec_fn=unroot,
-                                stdout=subprocess.PIPE).stdout
+        return processes.popen(args,
+                               preexec_fn=unroot,
+                               stdout=processes.PIPE).stdout
     else:
-        subprocess.Popen(args,
-                         close_fds=True,
-                         preexec_fn=unroot,
-                         stdout=open(pathname, 'w')).communicate()
+        processes.run(args, preexec_fn=unroot, stdout=open(pathname, 'w'))
 
 
 def write_tree():
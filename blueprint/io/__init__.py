@@ -7,6 +7,12 @@ from blueprint import git
 import http
 
 
+# The content type of source tarballs by extension.
+CONTENT_TYPES = {'tar': 'application/x-tar',
+                 'tar.bz2': 'application/x-bzip2',
+                 'tar.gz': 'application/x-gzip'}
+
+
 def pull(server, secret, name):
     """
     Pull a blueprint from the secret and name on the configured server.
@@ -79,9 +85,11 @@ def push(server, secret, b):
             blob = git.blob(tree, filename)
             content = git.content(blob)
             logging.info('storing source tarballs - this may take a while')
+            content_type = CONTENT_TYPES.get(filename.partition('.')[2],
+                                             'application/octet-stream')
             r = http.put('/{0}/{1}/{2}'.format(secret, b.name, filename),
                          content,
-                         {'Content-Type': 'application/x-tar'},
+                         {'Content-Type': content_type},
                          server=server)
             if 202 == r.status:
                 pass
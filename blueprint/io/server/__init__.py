@@ -163,7 +163,8 @@ def put_blueprint(secret, name):
     if b is not None and b is not False:
         for filename in set(b.sources.itervalues()) - \
                         set(request.json.get('sources', {}).itervalues()):
-            backend.delete_tarball(secret, name, filename[0:-4])
+            sha, _, extension = filename.partition('.')
+            backend.delete_tarball(secret, name, sha, extension)
 
     # Store the blueprint JSON in S3.
     if not backend.put_blueprint(secret, name, request.data):
@@ -175,13 +176,13 @@ def put_blueprint(secret, name):
 
 
 @app.route('/<secret>/<name>/<sha>.tar', methods=['GET'])
-def get_tarball(secret, name, sha):
+def get_tarball(secret, name, sha, extension='tar'):
     validate_secret(secret)
     validate_name(name)
     sha = sha.lower()
     validate_sha(sha)
 
-    content_length = backend.head_tarball(secret, name, sha)
+    content_length = backend.head_tarball(secret, name, sha, extension)
     if content_length is None:
         abort(404)
 
@@ -190,11 +191,22 @@ def get_tarball(secret, name, sha):
     librato.count('blueprint-io-server.bandwidth.out', content_length)
     statsd.update('blueprint-io-server.bandwidth.out', content_length)
 
-    return redirect(backend.url_for_tarball(secret, name, sha), code=301)
+    return redirect(backend.url_for_tarball(secret, name, sha, extension),
+                    code=301)
+
+
+@app.route('/<secret>/<name>/<sha>.tar.bz2', methods=['GET'])
+def get_tarball_bz2(secret, name, sha):
+    return get_tarball(secret, name, sha, 'tar.bz2')
+
+
+@app.route('/<secret>/<name>/<sha>.tar.gz', methods=['GET'])
+def get_tarball_gz(secret, name, sha):
+    return get_tarball(secret, name, sha, 'tar.gz')
 
 
 @app.route('/<secret>/<name>/<sha>.tar', methods=['PUT'])
-def put_tarball(secret, name, sha):
+def put_tarball(secret, name, sha, extension='tar'):
     validate_secret(secret)
     validate_name(name)
     sha = sha.lower()
@@ -214,11 +226,11 @@ def put_tarball(secret, name, sha):
         abort(404)
     elif b is False:
         abort(502)
-    if '{0}.tar'.format(sha) not in b.sources.itervalues():
+    if '{0}.{1}'.format(sha, extension) not in b.sources.itervalues():
         abort(400)
 
     # Store the tarball in S3.
-    if not backend.put_tarball(secret, name, sha, request.data):
+    if not backend.put_tarball(secret, name, sha, request.data, extension):
         abort(502)
 
     return MeteredResponse(response='',
@@ -226,6 +238,16 @@ def put_tarball(secret, name, sha):
                            content_type='text/plain')
 
 
+@app.route('/<secret>/<name>/<sha>.tar.bz2', methods=['PUT'])
+def put_tarball_bz2(secret, name, sha):
+    return put_tarball(secret, name, sha, 'tar.bz2')
+
+
+@app.route('/<secret>/<name>/<sha>.tar.gz', methods=['PUT'])
+def put_tarball_gz(secret, name, sha):
+    return put_tarball(secret, name, sha, 'tar.gz')
+
+
 @app.route('/<secret>/<name>/<name2>.sh', methods=['GET'])
 def sh(secret, name, name2):
     if 'user-data' == name2:
@@ -45,8 +45,8 @@ def delete_blueprint(secret, name):
     return delete(key_for_blueprint(secret, name))
 
 
-def delete_tarball(secret, name, sha):
-    return delete(key_for_tarball(secret, name, sha))
+def delete_tarball(secret, name, sha, extension='tar'):
+    return delete(key_for_tarball(secret, name, sha, extension))
 
 
 def get(key):
@@ -74,8 +74,8 @@ def get_blueprint(secret, name):
     return get(key_for_blueprint(secret, name))
 
 
-def get_tarball(secret, name, sha):
-    return get(key_for_tarball(secret, name, sha))
+def get_tarball(secret, name, sha, extension='tar'):
+    return get(key_for_tarball(secret, name, sha, extension))
 
 
 def head(key):
@@ -105,8 +105,8 @@ def head_blueprint(secret, name):
     return head(key_for_blueprint(secret, name))
 
 
-def head_tarball(secret, name, sha):
-    return head(key_for_tarball(secret, name, sha))
+def head_tarball(secret, name, sha, extension='tar'):
+    return head(key_for_tarball(secret, name, sha, extension))
 
 
 def key_for_blueprint(secret, name):
@@ -115,10 +115,11 @@ def key_for_blueprint(secret, name):
                                 'blueprint.json')
 
 
-def key_for_tarball(secret, name, sha):
-    return '{0}/{1}/{2}.tar'.format(secret,
+def key_for_tarball(secret, name, sha, extension='tar'):
+    return '{0}/{1}/{2}.{3}'.format(secret,
                                     name,
-                                    sha)
+                                    sha,
+                                    extension)
 
 
 def list(key):
@@ -169,8 +170,8 @@ def put_blueprint(secret, name, data):
     return put(key_for_blueprint(secret, name), data)
 
 
-def put_tarball(secret, name, sha, data):
-    return put(key_for_tarball(secret, name, sha), data)
+def put_tarball(secret, name, sha, data, extension='tar'):
+    return put(key_for_tarball(secret, name, sha, extension), data)
 
 
 def url_for(key):
@@ -184,5 +185,5 @@ def url_for_blueprint(secret, name):
     return url_for(key_for_blueprint(secret, name))
 
 
-def url_for_tarball(secret, name, sha):
-    return url_for(key_for_tarball(secret, name, sha))
+def url_for_tarball(secret, name, sha, extension='tar'):
+    return url_for(key_for_tarball(secret, name, sha, extension))
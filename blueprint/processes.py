@@ -0,0 +1,325 @@
+"""
+Start every child process Blueprint needs.  Running them all through here
+limits how many run at once and accounts for the cost of each command:
+how many times it ran, how long it took, and how much it wrote to standard
+output.  Those that only inspect the server may be recorded into or
+replayed from a fixture bundle by `blueprint.fixtures`.
+
+The limit is on threads running child processes rather than on the child
+processes themselves.  A thread that already has one running may start
+more, such as the consumer of a pipe whose producer is still running,
+without waiting, so no thread ever waits for a slot while holding one and
+any limit of at least 1 is safe.
+"""
+
+from collections import defaultdict
+from cStringIO import StringIO
+import os
+import os.path
+import subprocess
+import threading
+import time
+
+from blueprint import fixtures
+
+
+PIPE = subprocess.PIPE
+
+# Statistics for each command by name: the number of times it ran, the
+# total seconds it ran for, and the total bytes read from its standard
+# output.
+_statistics = defaultdict(lambda: [0, 0.0, 0])
+
+# Guards `_statistics`, the count of child processes each thread has
+# running, and the creation of the semaphore that limits the number of
+# threads with child processes running.  Reentrant because an abandoned
+# child process may give up its slot from `__del__` at any time.
+_lock = threading.RLock()
+
+# The count of child processes the current thread has running, in a list
+# so each child process can decrement the count of the thread that started
+# it.
+_local = threading.local()
+
+
+def popen(args, **kwargs):
+    """
+    Start a child process as `subprocess.Popen` would, after waiting for
+    another thread's to finish if too many threads already have some
+    running, and return it as a `Process`.  File descriptors are closed in
+    the child unless told otherwise.
+    """
+    return Process(args, **kwargs)
+
+
+def run(args, input=None, **kwargs):
+    """
+    Run a child process to completion, sending it `input` if given, and
+    return its exit status and standard output and error.  Output that
+    isn't piped is `None`.
+    """
+    p = popen(args, **kwargs)
+    with p:
+        stdout, stderr = p.communicate(input)
+    return p.returncode, stdout, stderr
+
+
+def statistics():
+    """
+    Return a `dict` of each command's name to the number of times it ran,
+    the total seconds it ran for, and the total bytes read from its
+    standard output.
+    """
+    with _lock:
+        return dict([(name, tuple(s)) for name, s in _statistics.iteritems()])
+
+
+def _semaphore():
+    """
+    Return the semaphore that limits the number of threads with child
+    processes running at once to the `limit` from `blueprint.cfg`(5).
+    """
+    with _lock:
+        if not hasattr(_semaphore, '_cache'):
+            from blueprint import cfg
+            _semaphore._cache = threading.BoundedSemaphore(
+                max(1, cfg.getint('processes', 'limit')))
+        return _semaphore._cache
+
+
+class Process(object):
+    """
+    A child process.  Its slot is given up and its statistics recorded when
+    it's waited for, which happens automatically when its standard output
+    is read to the end or closed or when it's used as a context manager and
+    the context exits, even if waiting raises.  As a last resort, a child
+    process that's abandoned without being waited for gives up its slot
+    once it and its standard output are garbage.
+    """
+
+    def __init__(self, args, **kwargs):
+        kwargs.setdefault('close_fds', True)
+        self.name = os.path.basename(args[0])
+        self._child = _Child(self.name, args)
+        try:
+            if fixtures.replays(self.name):
+                p = _Replay(args, **kwargs)
+            else:
+                p = subprocess.Popen(args, **kwargs)
+        except OSError:
+            self._child.abandon()
+            if fixtures.records(self.name):
+                fixtures.record(args, None, None)
+            raise
+        except:
+            self._child.abandon()
+            raise
+        self._child.p = p
+
+        # Keep everything read from the standard output of commands being
+        # recorded so it can be recorded along with their exit status.
+        if fixtures.records(self.name):
+            self._child.output = []
+
+        self.pid = p.pid
+        self.stdin = p.stdin
+        self.stdout = None
+        if p.stdout is not None:
+            self.stdout = _Stream(self._child, p.stdout)
+        self.stderr = p.stderr
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Wait for the child process, closing its standard input and output
+        first in case the caller stopped early, so it can't keep its slot.
+        """
+        if self._child.reaped:
+            return
+        if self.stdin is not None:
+            self.stdin.close()
+        if self.stdout is not None:
+            self.stdout.close()
+        self.wait()
+
+    @property
+    def returncode(self):
+        return self._child.p.returncode
+
+    def communicate(self, input=None):
+        try:
+            stdout, stderr = self._child.p.communicate(input)
+            self._child.count(stdout or '')
+        finally:
+            self._child.reap()
+        return stdout, stderr
+
+    def wait(self):
+        return self._child.wait()
+
+
+class _Child(object):
+    """
+    The slot, statistics, and recorded output of a child process.  This is
+    shared by the `Process` and its standard output, neither of which it
+    refers to, so it's garbage as soon as both are, even if they refer to
+    each other.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.bytes = 0
+        self.output = None
+        self.p = None
+        self.reaped = True
+        self._released = True
+
+        # Take a slot unless this thread already holds one.
+        try:
+            self._held = _local.held
+        except AttributeError:
+            self._held = _local.held = [0]
+        with _lock:
+            nested = 0 < self._held[0]
+        if not nested:
+            _semaphore().acquire()
+        with _lock:
+            self._held[0] += 1
+            self.reaped = self._released = False
+
+        self._start = time.time()
+
+    def __del__(self):
+
+        # Only a backstop for child processes abandoned without being waited
+        # for.  At interpreter shutdown this module's globals may already
+        # be `None`, when there's no slot left to give up anyway.
+        if None in (_lock, _semaphore, _statistics, fixtures, time):
+            return
+        if not self.reaped:
+            self.reap()
+
+    def abandon(self):
+        """
+        Give up the slot of a child process that couldn't be started, which
+        has no statistics to record.
+        """
+        self.reaped = True
+        self.release()
+
+    def count(self, s):
+        self.bytes += len(s)
+        if self.output is not None:
+            self.output.append(s)
+
+    def reap(self):
+        """
+        Record the statistics of a child process that's finished or been
+        abandoned and give up its slot.  Its output is only recorded into a
+        fixture bundle if it finished.
+        """
+        with _lock:
+            if self.reaped:
+                return
+            self.reaped = True
+            s = _statistics[self.name]
+            s[0] += 1
+            s[1] += time.time() - self._start
+            s[2] += self.bytes
+        self.release()
+        if self.output is not None \
+        and self.p is not None \
+        and self.p.returncode is not None:
+            fixtures.record(self.args, self.p.returncode, ''.join(self.output))
+
+    def release(self):
+        """
+        Give up this child process's share of its thread's slot.  The slot
+        itself is given up when the thread has no child processes left.
+        """
+        with _lock:
+            if self._released:
+                return
+            self._released = True
+            self._held[0] -= 1
+            release = 0 == self._held[0]
+        if release:
+            _semaphore().release()
+
+    def wait(self):
+        try:
+            return self.p.wait()
+        finally:
+            self.reap()
+
+
+class _Replay(object):
+    """
+    A stand-in for `subprocess.Popen` that replays a recorded command rather
+    than running it.  Raises `OSError` as `subprocess.Popen` would if the
+    command wasn't found when it was recorded.
+    """
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None, **kwargs):
+        self.returncode, output = fixtures.replay(args)
+        self.pid = None
+        self.stdin, self.stdout, self.stderr = None, None, None
+        if PIPE == stdin:
+            self.stdin = open(os.devnull, 'w')
+        if PIPE == stdout:
+            self.stdout = StringIO(output)
+        if PIPE == stderr:
+            self.stderr = StringIO('')
+
+    def communicate(self, input=None):
+        if self.stdin is not None:
+            self.stdin.close()
+        return (None if self.stdout is None else self.stdout.read(),
+                None if self.stderr is None else self.stderr.read())
+
+    def wait(self):
+        return self.returncode
+
+
+class _Stream(object):
+    """
+    A child process's standard output, which counts the bytes read from it
+    and waits for the process at end-of-file.
+    """
+
+    def __init__(self, child, f):
+        self._child = child
+        self._f = f
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            self._child.wait()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def next(self):
+        line = self.readline()
+        if '' == line:
+            raise StopIteration
+        return line
+
+    def read(self, size=-1):
+        return self._count(self._f.read(size), size)
+
+    def readline(self, size=-1):
+        return self._count(self._f.readline(size), size)
+
+    def _count(self, s, size):
+        self._child.count(s)
+        if '' == s and 0 != size:
+            self._child.wait()
+        return s
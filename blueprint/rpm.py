@@ -0,0 +1,213 @@
+"""
+Query the RPM database in bulk rather than forking `rpm`(8) once per
+package, pathname, or capability.  One `rpm -qa` query reads every
+package along with its capabilities and files.
+"""
+
+from collections import defaultdict
+import logging
+import os.path
+import threading
+
+from blueprint import cache
+from blueprint import processes
+
+
+DATABASES = ('/var/lib/rpm/Packages',
+             '/var/lib/rpm/rpmdb.sqlite')
+
+# Guards the caches of `_database`, `_index`, and `depends`.  Reentrant
+# because `depends` may build the index while holding it.
+_lock = threading.RLock()
+
+# The query format for `rpm -qa`.  Each package is introduced by a line
+# beginning with `\x1D` and followed by one line per file it contains.
+QUERYFORMAT = ('\x1D%{NAME}\x1E%{GROUP}\x1E%{EPOCH}'
+               '\x1E%{VERSION}-%{RELEASE}\x1E%{ARCH}'
+               '\x1E[%{PROVIDES}\x1F]\x1E[%{REQUIRENAME}\x1F]\n'
+               '[%{FILENAMES}\x1E%{FILEMD5S}\x1E%{FILESIZES}'
+               '\x1E%{FILEMODES:octal}\x1E%{FILELINKTOS}\n]')
+
+
+def depends(package):
+    """
+    Return the set of packages that provide the capabilities `package`
+    requires, not counting RPM's own `rpmlib(...)` capabilities.
+    """
+    with _lock:
+        if not hasattr(depends, '_cache'):
+            depends._cache = {}
+        if package not in depends._cache:
+            s = set()
+            for cap in _index()['requires'].get(package, []):
+                if 'rpmlib' == cap[0:6]:
+                    continue
+                name = whatprovides(cap)
+                if name is not None:
+                    s.add(name)
+            depends._cache[package] = frozenset(s)
+        return depends._cache[package]
+
+
+def digest(pathname):
+    """
+    Return the MD5 (or, with newer RPM, SHA-256) sum of the packaged version
+    of `pathname` or `None` if it doesn't come from an RPM.  The sum of a
+    symbolic link is that of its target.
+    """
+    try:
+        return _file(pathname)[0] or None
+    except KeyError:
+        return None
+
+
+def files(package):
+    """
+    Return the list of pathnames in `package`, as `rpm -ql` would, or `[]`
+    if it isn't installed.
+    """
+    return _index()['package_files'].get(package, [])
+
+
+def installed():
+    """
+    Return a list of `(name, group, epoch, version, arch)` tuples for each
+    installed package, as `rpm -qa` would.
+    """
+    return [package[0:5] for package in _database()[0]]
+
+
+def packages(pathname):
+    """
+    Return the list of packages that contain `pathname`, as `rpm -qf` would,
+    or `[]`.
+    """
+    return list(_index()['owners'].get(pathname, []))
+
+
+def size(pathname):
+    """
+    Return the size in bytes of the packaged version of `pathname` or `None`
+    if it doesn't come from an RPM.  The size of a symbolic link is that of
+    its target.
+    """
+    try:
+        return int(_file(pathname)[1])
+    except (KeyError, ValueError):
+        return None
+
+
+def whatprovides(cap):
+    """
+    Return the name of the package that provides `cap` or `None`.  Files
+    aren't listed as capabilities so they're resolved by their owner.
+    """
+    try:
+        return _index()['provides'][cap]
+    except KeyError:
+        pass
+    try:
+        return _index()['owners'].get(cap, [])[0]
+    except IndexError:
+        return None
+
+
+def _database():
+    """
+    Read the RPM database with one `rpm -qa` query.  Return a list of
+    `(name, group, epoch, version, arch, provides, requires)` tuples and a
+    list of `(name, pathname, digest, size, mode, linkto)` tuples.  Both
+    are cached on disk until the RPM database changes.
+    """
+    if hasattr(_database, '_cache'):
+        return _database._cache
+    with _lock:
+        if not hasattr(_database, '_cache'):
+            _database._cache = _read_database()
+    return _database._cache
+
+
+def _read_database():
+    key = cache.fingerprint(*DATABASES)
+    database = cache.load('rpm-database', key)
+    if database is None:
+        database = ([], [])
+        try:
+            p = processes.popen(['rpm', '-qa', '--qf={0}'.format(QUERYFORMAT)],
+                                stdout=processes.PIPE,
+                                stderr=processes.PIPE)
+        except OSError:
+            return database
+        logging.info('reading the RPM database')
+        with p:
+            database = _parse(p.stdout)
+        if 0 == p.returncode:
+            cache.dump('rpm-database', key, database)
+    return database
+
+
+def _parse(lines):
+    """
+    Parse the lines `rpm -qa` prints in `QUERYFORMAT` into the lists of
+    packages and files `_database` returns.  The files of a package whose
+    line can't be parsed are skipped along with it.
+    """
+    database = ([], [])
+    name = None
+    for line in lines:
+        fields = line.rstrip('\n').split('\x1E')
+        if '\x1D' == line[0]:
+            if 7 != len(fields):
+                name = None
+                continue
+            fields[0] = name = fields[0][1:]
+            fields[5] = [cap for cap in fields[5].split('\x1F') if cap]
+            fields[6] = [cap for cap in fields[6].split('\x1F') if cap]
+            database[0].append(tuple(fields))
+        elif name is not None and 5 == len(fields):
+            database[1].append(tuple([name] + fields))
+    return database
+
+
+def _index():
+    """
+    Index the RPM database by package, pathname, and capability.
+    """
+    if hasattr(_index, '_cache'):
+        return _index._cache
+    with _lock:
+        if not hasattr(_index, '_cache'):
+            _index._cache = _build_index()
+    return _index._cache
+
+
+def _build_index():
+    packages, files = _database()
+    index = {'files': {},
+             'owners': defaultdict(list),
+             'package_files': defaultdict(list),
+             'provides': {},
+             'requires': defaultdict(list)}
+    for name, group, epoch, version, arch, provides, requires in packages:
+        index['provides'].update([(cap, name) for cap in provides])
+        index['requires'][name].extend(requires)
+    for name, pathname, d, size, mode, linkto in files:
+        index['files'][pathname] = (d, size, mode, linkto)
+        if name not in index['owners'][pathname]:
+            index['owners'][pathname].append(name)
+        index['package_files'][name].append(pathname)
+    return index
+
+
+def _file(pathname):
+    """
+    Return the `(digest, size, mode, linkto)` tuple of the packaged version
+    of `pathname`, following one symbolic link, or raise `KeyError`.
+    """
+    d, size, mode, linkto = _index()['files'][pathname]
+    if '120777' == mode:
+        if '/' != linkto[0:1]:
+            linkto = os.path.normpath(os.path.join(os.path.dirname(pathname),
+                                                   linkto))
+        d, size, mode, linkto = _index()['files'][linkto]
+    return d, size, mode, linkto
@@ -1,14 +1,15 @@
 from collections import defaultdict
-import fnmatch
 import glob
-import json
 import logging
 import os
 import os.path
 import re
-import subprocess
 
+from blueprint import cache
 from blueprint import deps
+from blueprint import dpkg
+from blueprint import processes
+from blueprint import rpm
 from blueprint import util
 
 
@@ -83,9 +84,6 @@ IGNORE = {'*~': False,
           '/etc/yum.repos.d': True}
 
 
-CACHE = '/tmp/blueprintignore'
-
-
 def defaults():
     """
     Parse `/etc/blueprintignore` and `~/.blueprintignore` to build the
@@ -94,15 +92,15 @@ def defaults():
     r = None
 
     # Check for a fresh cache of the complete blueprintignore(5) rules.
-    if _mtime('/etc/blueprintignore') < _mtime(CACHE) \
-    and _mtime(os.path.expanduser('~/.blueprintignore')) < _mtime(CACHE) \
-    and _mtime(__file__) < _mtime(CACHE):
-        try:
-            r = Rules(json.load(open(CACHE)))
-            logging.info('using cached blueprintignore(5) rules')
-            return r
-        except (OSError, ValueError):
-            pass
+    # Package rules include dependencies so the cache is only good until
+    # packages are installed or removed.
+    key = cache.fingerprint('/etc/blueprintignore',
+                            os.path.expanduser('~/.blueprintignore'),
+                            __file__) + cache.packages()
+    state = cache.load('rules', key)
+    if state is not None:
+        logging.info('using cached blueprintignore(5) rules')
+        return Rules.from_state(state)
 
     # Cache things that are ignored by default first.
     r = Rules({
@@ -124,10 +122,10 @@ def defaults():
     except IOError:
         pass
 
-    # Store the cache to disk.
-    f = _cache_open(CACHE, 'w')
-    json.dump(r, f, indent=2, sort_keys=True)
-    f.close()
+    # Store the cache to disk, along with the dependency closures found
+    # while building it.
+    cache.dump('rules', key, r.state())
+    deps.dump()
 
     return r
 
@@ -148,13 +146,12 @@ def _apt():
     they're already guaranteed (to some degree) to be there.
     """
 
-    CACHE = '/tmp/blueprint-apt-exclusions'
-
-    # Read from a cached copy.
-    try:
-        return set([line.rstrip() for line in open(CACHE)])
-    except IOError:
-        pass
+    # Read from a cached copy that's only good until packages are installed
+    # or removed or the packages listed here change.
+    key = cache.fingerprint(dpkg.STATUS, __file__)
+    s = cache.load('apt-exclusions', key)
+    if s is not None:
+        return set(s)
     logging.info('searching for APT packages to exclude')
 
     # Start with the root packages for the various Ubuntu installations.
@@ -171,35 +168,33 @@ def _apt():
              'wireless-crda'])
 
     # Find the essential and required packages.  Every server's got 'em, no
-    # one wants to muddle their blueprint with 'em.
-    for field in ('Essential', 'Priority'):
-        try:
-            p = subprocess.Popen(['dpkg-query',
-                                  '-f=${{Package}} ${{{0}}}\n'.format(field),
-                                  '-W'],
-                                 close_fds=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        except OSError:
-            _cache_open(CACHE, 'w').close()
-            return s
+    # one wants to muddle their blueprint with 'em.  Both fields are read
+    # in one query.
+    try:
+        p = processes.popen(['dpkg-query',
+                             '-f=${Package} ${Essential} ${Priority}\n',
+                             '-W'],
+                            stdout=processes.PIPE,
+                            stderr=processes.PIPE)
+    except OSError:
+        cache.dump('apt-exclusions', key, sorted(s))
+        return s
+    with p:
         for line in p.stdout:
             try:
-                package, property = line.rstrip().split()
-                if property in ('yes', 'important', 'required', 'standard'):
-                    s.add(package)
+                package, essential, priority = line.rstrip('\n').split(' ', 2)
             except ValueError:
-                pass
+                continue
+            if essential in ('yes', 'important', 'required', 'standard') \
+            or priority in ('yes', 'important', 'required', 'standard'):
+                s.add(package)
 
     # Walk the dependency tree all the way to the leaves.
     s = deps.apt(s)
 
     # Write to a cache.
     logging.info('caching excluded APT packages')
-    f = _cache_open(CACHE, 'w')
-    for package in sorted(s):
-        f.write('{0}\n'.format(package))
-    f.close()
+    cache.dump('apt-exclusions', key, sorted(s))
 
     return s
 
@@ -210,61 +205,41 @@ def _yum():
     they're already guaranteed (to some degree) to be there.
     """
 
-    CACHE = '/tmp/blueprint-yum-exclusions'
-
-    # Read from a cached copy.
-    try:
-        return set([line.rstrip() for line in open(CACHE)])
-    except IOError:
-        pass
+    # Read from a cached copy that's only good until packages are installed
+    # or removed or the packages listed here change.
+    key = cache.fingerprint(__file__, *rpm.DATABASES)
+    s = cache.load('yum-exclusions', key)
+    if s is not None:
+        return set(s)
     logging.info('searching for Yum packages to exclude')
 
     # Start with a few groups that install common packages.
     s = set(['gpg-pubkey'])
     pattern = re.compile(r'^   (\S+)')
     try:
-        p = subprocess.Popen(['yum', 'groupinfo',
-                              'core','base', 'gnome-desktop'],
-                             close_fds=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        p = processes.popen(['yum', 'groupinfo',
+                             'core','base', 'gnome-desktop'],
+                            stdout=processes.PIPE,
+                            stderr=processes.PIPE)
     except OSError:
-        _cache_open(CACHE, 'w').close()
+        cache.dump('yum-exclusions', key, sorted(s))
         return s
-    for line in p.stdout:
-        match = pattern.match(line)
-        if match is not None:
-            s.add(match.group(1))
+    with p:
+        for line in p.stdout:
+            match = pattern.match(line)
+            if match is not None:
+                s.add(match.group(1))
 
     # Walk the dependency tree all the way to the leaves.
     s = deps.yum(s)
 
     # Write to a cache.
     logging.info('caching excluded Yum packages')
-    f = _cache_open(CACHE, 'w')
-    for package in sorted(s):
-        f.write('{0}\n'.format(package))
-    f.close()
+    cache.dump('yum-exclusions', key, sorted(s))
 
     return s
 
 
-def _cache_open(pathname, mode):
-    f = open(pathname, mode)
-    if util.via_sudo():
-        uid = int(os.environ['SUDO_UID'])
-        gid = int(os.environ['SUDO_GID'])
-        os.fchown(f.fileno(), uid, gid)
-    return f
-
-
-def _mtime(pathname):
-    try:
-        return os.stat(pathname).st_mtime
-    except OSError:
-        return 0
-
-
 class Rules(defaultdict):
     """
     Ordered lists of rules for ignoring/unignoring particular resources.
@@ -273,73 +248,73 @@ class Rules(defaultdict):
 
     def __init__(self, *args, **kwargs):
         super(Rules, self).__init__(list, *args, **kwargs)
+        self._compiled = {}
 
-    def _ignore_pathname(self, restype, dirname, pathname, ignored=False):
+    @classmethod
+    def from_state(cls, state):
+        """
+        Instantiate a `Rules` object, compiled forms and all, from the
+        return value of `Rules.state`.
+        """
+        rules, compiled = state
+        r = cls(rules)
+        for restype, compiled_state in compiled.iteritems():
+            compiled = COMPILERS[restype][0].from_state(compiled_state)
+            compiled.source, compiled.length = r[restype], len(r[restype])
+            r._compiled[restype] = compiled
+        return r
+
+    def _ignore_pathname(self, restype, pathname, ignored=False):
         """
         Return `True` if the `gitignore`(5)-style `~/.blueprintignore`
         file says the given file should be ignored.  The starting state
         of the file may be overridden by setting `ignored` to `True`.
         """
-        pathname = util.unicodeme(pathname)
+        return self._compile(restype).ignore(pathname, ignored)
 
-        # Determine if the `pathname` matches the `pattern`.  `filename` is
-        # given as a convenience.  See `gitignore`(5) for the rules in play.
-        def match(filename, pathname, pattern):
-            dir_only = '/' == pattern[-1]
-            pattern = pattern.rstrip('/')
-            if '/' not in pattern:
-                if fnmatch.fnmatch(filename, pattern):
-                    return os.path.isdir(pathname) if dir_only else True
-            else:
-                for p in glob.glob(os.path.join(dirname, pattern)):
-                    p = util.unicodeme(p)
-                    if pathname == p or pathname.startswith('{0}/'.format(p)):
-                        return os.path.isdir(pathname) if dir_only else True
-            return False
-
-        # Iterate over exclusion rules until a match is found.  Then iterate
-        # over inclusion rules that appear later.  If there are no matches,
-        # include the file.  If only an exclusion rule matches, exclude the
-        # file.  If an inclusion rule also matches, include the file.
-        filename = os.path.basename(pathname)
-        for pattern, negate in self[restype]:
-            if ignored != negate or not match(filename, pathname, pattern):
-                continue
-            ignored = not ignored
-
-        return ignored
+    def _compile(self, restype):
+        """
+        Return the rules of the given type compiled as `COMPILERS` says,
+        compiling them again if they have changed since.
+        """
+        rules = self[restype]
+        compiled = self._compiled.get(restype)
+        if compiled is None \
+        or compiled.source is not rules \
+        or compiled.length != len(rules):
+            cls, args = COMPILERS[restype][0], COMPILERS[restype][1:]
+            compiled = cls(rules, *args)
+            compiled.source, compiled.length = rules, len(rules)
+            self._compiled[restype] = compiled
+        return compiled
 
     def ignore_file(self, pathname, ignored=False):
         """
         Return `True` if the given pathname should be ignored.
         """
-        return self._ignore_pathname('file', '/etc', pathname, ignored)
+        return self._ignore_pathname('file', pathname, ignored)
+
+    def ignore_file_tree(self, dirname):
+        """
+        Return `True` if the given directory and everything beneath it
+        should be ignored because no later negated rule could include
+        anything beneath it.  Directory walks may prune such directories.
+        """
+        return self._compile('file').ignore_tree(dirname)
 
     def ignore_package(self, manager, package, ignored=False):
         """
-        Iterate over package exclusion rules looking for exact matches. As
-        with files, search for a negated rule after finding a match. Return
-        `True` to indicate the package should be ignored.
+        Look up package exclusion rules that match exactly or by wildcard.
+        As with files, search for a negated rule after finding a match.
+        Return `True` to indicate the package should be ignored.
         """
-        for m, p, negate in self['package']:
-            if ignored != negate \
-            or manager != m and '*' != m \
-            or package != p and '*' != p:
-                continue
-            ignored = not ignored
-        return ignored
+        return self._compile('package').ignore(manager, package, ignored)
 
     def ignore_service(self, manager, service, ignored=False):
         """
         Return `True` if a given service should be ignored.
         """
-        for m, s, negate in self['service']:
-            if ignored != negate \
-            or manager != m and '*' != m \
-            or service != s and '*' != s:
-                continue
-            ignored = not ignored
-        return ignored
+        return self._compile('service').ignore(manager, service, ignored)
 
     def ignore_source(self, pathname, ignored=False):
         """
@@ -347,8 +322,16 @@ class Rules(defaultdict):
         on directories will create new source tarballs.  Other rules will
         ignore files within those tarballs.
         """
-        return self._ignore_pathname('source', '/', pathname, ignored)
+        return self._ignore_pathname('source', pathname, ignored)
 
+    def state(self):
+        """
+        Return these rules and their compiled forms as built-in types
+        suitable for `marshal`.
+        """
+        return (dict(self),
+                dict([(restype, self._compile(restype).state())
+                      for restype in self if restype in COMPILERS]))
 
     def parse(self, f, negate=False):
         """
@@ -412,3 +395,280 @@ class Rules(defaultdict):
                 self[restype].append((pattern, ignored))
 
         return self
+
+
+class PathnameMatcher(object):
+    """
+    An ordered list of `gitignore`(5)-style pathname rules compiled so
+    pathnames may be matched without consulting the filesystem.  Literal
+    pathnames are stored in a trie keyed by path segment, literal filenames
+    in a `dict`, and wildcards as regular expressions screened by a single
+    combined regular expression.
+    """
+
+    def __init__(self, rules, dirname):
+        self.dirname = dirname
+        self.rules = []
+        self.filenames = defaultdict(list)
+        self.filename_patterns = []
+        self.trie = [[], {}]
+        self.pathname_patterns = []
+        for i, (pattern, negate) in enumerate(rules):
+            pattern = util.unicodeme(pattern)
+            dir_only = '/' == pattern[-1:]
+            pattern = pattern.rstrip('/')
+            self.rules.append((pattern, dir_only, negate))
+
+            # Patterns without a slash match the filename in any directory
+            # as `fnmatch`(3) would.
+            if '/' not in pattern:
+                if glob.has_magic(pattern):
+                    self.filename_patterns.append(
+                        (i, _translate(pattern) + r'\Z'))
+                else:
+                    self.filenames[pattern].append(i)
+                continue
+
+            # Patterns with a slash match as `glob`(3) would relative to
+            # `dirname`, plus everything beneath what they match.
+            pathname = os.path.join(dirname, pattern)
+            if glob.has_magic(pathname):
+                self.pathname_patterns.append((i, '/'.join([
+                    _translate(segment, hidden=True)
+                    if glob.has_magic(segment) else re.escape(segment)
+                    for segment in pathname.split('/')]) + r'(?:/|\Z)'))
+            else:
+                node = self.trie
+                for segment in pathname.split('/'):
+                    node = node[1].setdefault(segment, [[], {}])
+                node[0].append(i)
+
+        self._compile()
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Instantiate a `PathnameMatcher` from the return value of
+        `PathnameMatcher.state`.
+        """
+        matcher = cls([], '/')
+        (matcher.dirname,
+         matcher.rules,
+         matcher.filenames,
+         matcher.filename_patterns,
+         matcher.trie,
+         matcher.pathname_patterns) = state
+        matcher._compile()
+        return matcher
+
+    def _compile(self):
+        self.filename_re = _combine(self.filename_patterns)
+        self.filename_regexes = [(i, re.compile(regex, re.S))
+                                 for i, regex in self.filename_patterns]
+        self.pathname_re = _combine(self.pathname_patterns)
+        self.pathname_regexes = [(i, re.compile(regex, re.S))
+                                 for i, regex in self.pathname_patterns]
+
+    def ignore(self, pathname, ignored=False):
+        """
+        Return `True` if `pathname` should be ignored, starting from the
+        state given by `ignored`.
+        """
+        pathname = util.unicodeme(pathname)
+
+        # Iterate over exclusion rules until a match is found.  Then iterate
+        # over inclusion rules that appear later.  If there are no matches,
+        # include the file.  If only an exclusion rule matches, exclude the
+        # file.  If an inclusion rule also matches, include the file.
+        for i in self.match(pathname):
+            pattern, dir_only, negate = self.rules[i]
+            if ignored != negate \
+            or dir_only and not os.path.isdir(pathname):
+                continue
+            ignored = not ignored
+
+        return ignored
+
+    def ignore_tree(self, dirname):
+        """
+        Return `True` if the directory `dirname` and every pathname beneath
+        it is ignored no matter the starting state.  This is only certain
+        when the last rule to match `dirname` is an exclusion that matches
+        everything beneath it, too, and no later inclusion could match
+        anything beneath it.
+        """
+        dirname = util.unicodeme(dirname)
+        indices = self.match(dirname)
+        if 0 == len(indices):
+            return False
+        pattern, dir_only, negate = self.rules[indices[-1]]
+        if negate or dir_only or '/' not in pattern:
+            return False
+
+        # Inclusions without a slash could match any filename.  Others could
+        # match beneath `dirname` if the literal part of their pathname is
+        # beneath, equal to, or above `dirname`.
+        for pattern, dir_only, negate in self.rules[indices[-1] + 1:]:
+            if not negate:
+                continue
+            if '/' not in pattern:
+                return False
+            segments = []
+            for segment in os.path.join(self.dirname, pattern).split('/'):
+                if glob.has_magic(segment):
+                    break
+                segments.append(segment)
+            prefix = '/'.join(segments)
+            if prefix == dirname \
+            or prefix.startswith(dirname + '/') \
+            or dirname.startswith(prefix + '/'):
+                return False
+
+        return True
+
+    def match(self, pathname):
+        """
+        Return the sorted indices of the rules that match `pathname`,
+        disregarding whether the rules require a directory.
+        """
+        filename = os.path.basename(pathname)
+        indices = list(self.filenames.get(filename, []))
+        if self.filename_re is not None and self.filename_re.match(filename):
+            indices.extend([i for i, regex in self.filename_regexes
+                            if regex.match(filename)])
+
+        # Literal pathnames match themselves and everything beneath them.
+        # Each pathname segment descends one level into the trie.
+        node = self.trie
+        for segment in pathname.split('/'):
+            node = node[1].get(segment)
+            if node is None:
+                break
+            indices.extend(node[0])
+
+        if self.pathname_re is not None and self.pathname_re.match(pathname):
+            indices.extend([i for i, regex in self.pathname_regexes
+                            if regex.match(pathname)])
+
+        return sorted(indices)
+
+    def state(self):
+        """
+        Return this matcher as built-in types suitable for `marshal`.  The
+        regular expressions are stored as patterns.
+        """
+        return (self.dirname,
+                self.rules,
+                dict(self.filenames),
+                self.filename_patterns,
+                self.trie,
+                self.pathname_patterns)
+
+
+class ResourceIndex(object):
+    """
+    An ordered list of `(manager, name, negate)` rules for packages or
+    services indexed by manager and name.  Rules that use `*` for either
+    are kept in their own buckets.
+    """
+
+    def __init__(self, rules):
+        self.negates = []
+        self.buckets = defaultdict(list)
+        for i, (manager, name, negate) in enumerate(rules):
+            self.negates.append(negate)
+            self.buckets[(manager, name)].append(i)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Instantiate a `ResourceIndex` from the return value of
+        `ResourceIndex.state`.
+        """
+        index = cls([])
+        index.negates, buckets = state
+        index.buckets.update(buckets)
+        return index
+
+    def ignore(self, manager, name, ignored=False):
+        """
+        Return `True` if the named resource should be ignored, starting
+        from the state given by `ignored`.
+        """
+        indices = []
+        for key in set([(manager, name),
+                        (manager, '*'),
+                        ('*', name),
+                        ('*', '*')]):
+            indices.extend(self.buckets.get(key, []))
+
+        # As with pathnames, rules are considered in their original order
+        # so negated rules only apply after a match.
+        for i in sorted(indices):
+            if ignored == self.negates[i]:
+                ignored = not ignored
+
+        return ignored
+
+    def state(self):
+        """
+        Return this index as built-in types suitable for `marshal`.
+        """
+        return (self.negates, dict(self.buckets))
+
+
+# How to compile the rules for each type of resource.  Pathname rules are
+# relative to the directory given.
+COMPILERS = {'file': (PathnameMatcher, '/etc'),
+             'package': (ResourceIndex,),
+             'service': (ResourceIndex,),
+             'source': (PathnameMatcher, '/')}
+
+
+def _combine(patterns):
+    """
+    Combine the regular expressions in the `(index, regex)` pairs into one
+    that matches if any of them do or `None` if there are none.
+    """
+    if 0 == len(patterns):
+        return None
+    return re.compile('|'.join(['(?:{0})'.format(regex)
+                                for i, regex in patterns]), re.S)
+
+
+def _translate(pattern, hidden=False):
+    """
+    Translate a shell pattern into a regular expression as `fnmatch` does
+    but never match a slash.  When `hidden` is `True`, follow `glob`(3) in
+    not matching a leading dot unless the pattern begins with one.
+    """
+    i, n = 0, len(pattern)
+    regex = hidden and '.' != pattern[0:1] and r'(?!\.)' or ''
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if '*' == c:
+            regex += '[^/]*'
+        elif '?' == c:
+            regex += '[^/]'
+        elif '[' == c:
+            j = i
+            if j < n and '!' == pattern[j]:
+                j += 1
+            if j < n and ']' == pattern[j]:
+                j += 1
+            while j < n and ']' != pattern[j]:
+                j += 1
+            if j >= n:
+                regex += r'\['
+            else:
+                stuff = pattern[i:j].replace('\\', r'\\')
+                i = j + 1
+                if '!' == stuff[0]:
+                    stuff = '^/' + stuff[1:]
+                elif '^' == stuff[0]:
+                    stuff = '\\' + stuff
+                regex += '[{0}]'.format(stuff)
+        else:
+            regex += re.escape(c)
+    return regex
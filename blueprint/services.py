@@ -8,8 +8,9 @@ from collections import defaultdict
 import logging
 import os.path
 import re
-import subprocess
 
+import dpkg
+import rpm
 import util
 import walk
 
@@ -21,9 +22,9 @@ pattern = re.compile(r'(/[/0-9A-Za-z_.-]+)')
 def services(b):
     logging.info('searching for service dependencies')
 
-    # Command fragments for listing the files in a package.
-    commands = {'apt': ['dpkg-query', '-L'],
-                'yum': ['rpm', '-ql']}
+    # Functions for listing the files in a package.
+    package_files = {'apt': dpkg.files,
+                     'yum': rpm.files}
 
     # Build a map of the directory that contains each file in the
     # blueprint to the pathname of that file.
@@ -53,13 +54,10 @@ def services(b):
         this service's package or in a directory in this service's package.
         """
         try:
-            p = subprocess.Popen(commands[package_manager] + [package],
-                                 close_fds=True,
-                                 stdout=subprocess.PIPE)
+            pathnames = package_files[package_manager](package)
         except KeyError:
             return
-        for line in p.stdout:
-            pathname = line.rstrip()
+        for pathname in pathnames:
             if pathname in b.files:
                 b.add_service_file(manager, service, pathname)
             elif pathname in dirs:
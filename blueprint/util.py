@@ -2,11 +2,22 @@
 Utility functions.
 """
 
+import contextlib
+import grp
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
+import pwd
 import re
-import subprocess
+import threading
+
+from blueprint import processes
+
+
+# Guards the creation of the caches behind `username` and `groupname`,
+# which are filled from several threads at once.
+_lock = threading.Lock()
 
 
 def arch():
@@ -14,17 +25,33 @@ def arch():
     Return the system's architecture according to dpkg or rpm.
     """
     try:
-        p = subprocess.Popen(['dpkg', '--print-architecture'],
-                             close_fds=True, stdout=subprocess.PIPE)
+        returncode, stdout, stderr = processes.run(
+            ['dpkg', '--print-architecture'], stdout=processes.PIPE)
     except OSError as e:
-        p = subprocess.Popen(['rpm', '--eval', '%_arch'],
-                             close_fds=True, stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if 0 != p.returncode:
+        returncode, stdout, stderr = processes.run(
+            ['rpm', '--eval', '%_arch'], stdout=processes.PIPE)
+    if 0 != returncode:
         return None
     return stdout.rstrip()
 
 
+def groupname(gid):
+    """
+    Return the name of the group with the given GID or the GID itself if
+    there is no such group.  Names are cached for the rest of the run since
+    each lookup may be a network round trip when NSS is backed by LDAP.
+    """
+    with _lock:
+        if not hasattr(groupname, '_cache'):
+            groupname._cache = {}
+    if gid not in groupname._cache:
+        try:
+            groupname._cache[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            groupname._cache[gid] = gid
+    return groupname._cache[gid]
+
+
 def lsb_release_codename():
     """
     Return the OS release's codename.
@@ -32,12 +59,12 @@ def lsb_release_codename():
     if hasattr(lsb_release_codename, '_cache'):
         return lsb_release_codename._cache
     try:
-        p = subprocess.Popen(['lsb_release', '-c'], stdout=subprocess.PIPE)
+        returncode, stdout, stderr = processes.run(['lsb_release', '-c'],
+                                                   stdout=processes.PIPE)
     except OSError:
         lsb_release_codename._cache = None
         return lsb_release_codename._cache
-    stdout, stderr = p.communicate()
-    if 0 != p.returncode:
+    if 0 != returncode:
         lsb_release_codename._cache = None
         return lsb_release_codename._cache
     match = re.search(r'\t(\w+)$', stdout)
@@ -54,6 +81,29 @@ pattern_upstart_1 = re.compile(r'start\s+on\s+runlevel\s+\[[2345]', re.S)
 pattern_upstart_2 = re.compile(r'start\s+on\s+\([^)]*(?:filesystem|filesystems|local-filesystems|mounted|net-device-up|remote-filesystems|startup|virtual-filesystems)[^)]*\)', re.S)
 
 
+@contextlib.contextmanager
+def parallel_map(n=None):
+    """
+    Yield a function like `map` that runs on a pool of as many threads as
+    the `workers` option in `blueprint.cfg`(5) allows, but no more than
+    `n`, or the builtin `map` itself if that's just one.  Either way the
+    results are in order.  The pool is closed when the context exits.
+    """
+    from blueprint import cfg
+    workers = cfg.getint('create', 'workers')
+    if n is not None:
+        workers = min(workers, n)
+    if 1 >= workers:
+        yield map
+        return
+    pool = ThreadPool(workers)
+    try:
+        yield pool.map
+    finally:
+        pool.close()
+        pool.join()
+
+
 def parse_service(pathname):
     """
     Parse a potential service init script or config file into the
@@ -99,6 +149,23 @@ def parse_service(pathname):
         raise ValueError('not a service')
 
 
+def prefetch_names():
+    """
+    Fill the caches behind `username` and `groupname` from the entire
+    `/etc/passwd` and `/etc/group` databases at once.  The first entry for
+    each ID wins, as it does for `getpwuid`(3) and `getgrgid`(3).
+    """
+    with _lock:
+        if not hasattr(username, '_cache'):
+            username._cache = {}
+        if not hasattr(groupname, '_cache'):
+            groupname._cache = {}
+    for pw in pwd.getpwall():
+        username._cache.setdefault(pw.pw_uid, pw.pw_name)
+    for gr in grp.getgrall():
+        groupname._cache.setdefault(gr.gr_gid, gr.gr_name)
+
+
 def rubygems_unversioned():
     """
     Determine whether RubyGems is suffixed by the Ruby language version.
@@ -135,6 +202,35 @@ def rubygems_path():
     return '/var/lib/gems'
 
 
+def tar_compression(filename):
+    """
+    Return the `tar`(1) option letter for the compression of the named
+    tarball, `z` for `gzip`(1) or `j` for `bzip2`(1), or `''` if it isn't
+    compressed.
+    """
+    if filename.endswith(('.tar.gz', '.tgz')):
+        return 'z'
+    if filename.endswith(('.tar.bz2', '.tbz2')):
+        return 'j'
+    return ''
+
+
+def username(uid):
+    """
+    Return the name of the user with the given UID or the UID itself if
+    there is no such user.  Names are cached for the rest of the run.
+    """
+    with _lock:
+        if not hasattr(username, '_cache'):
+            username._cache = {}
+    if uid not in username._cache:
+        try:
+            username._cache[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            username._cache[uid] = uid
+    return username._cache[uid]
+
+
 def via_sudo():
     """
     Return `True` if Blueprint was invoked via `sudo`(8), which indicates
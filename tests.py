@@ -1,10 +1,39 @@
+import bz2
 from flask.testing import FlaskClient
+import fnmatch
+import glob
+import hashlib
 import json
+import marshal
+import os
 import os.path
+import shutil
+import stat
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 
+import blueprint.backend
+from blueprint import cache
+from blueprint import context_managers
+from blueprint import deps
+from blueprint import dpkg
+from blueprint import fixtures
+from blueprint import fs
+from blueprint import git
+from blueprint import processes
+from blueprint import rpm
+from blueprint import rules
+from blueprint import util
 from blueprint.io.server import app
 
+# The files and sources backends, whose names in `blueprint.backend` are
+# taken by the functions they define.
+files = sys.modules['blueprint.backend.files']
+sources = sys.modules['blueprint.backend.sources']
+
 SECRET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_-'
 NAME = 'test'
 SHA = 'adff242fbc01ba3753abf8c3f9b45eeedec23ec6'
@@ -90,6 +119,13 @@ def test_PUT_tarball_invalid_data():
                      data=open(pathname).read())
     assert 400 == response.status_code
 
+def test_PUT_tarball_gz_invalid_data():
+    test_PUT_blueprint_sources()
+    response = c.put('/{0}/{1}/{2}.tar.gz'.format(SECRET, NAME, '0' * 40),
+                     content_type='application/x-gzip',
+                     data=open(pathname).read())
+    assert 400 == response.status_code
+
 def test_PUT_tarball_invalid_length_data():
     test_PUT_blueprint_sources()
     response = c.put('/{0}/{1}/{2}.tar'.format(SECRET, NAME, '0' * 40),
@@ -149,3 +185,1055 @@ def test_GET_tarball():
     test_PUT_tarball()
     response = c.get('/{0}/{1}/{2}.tar'.format(SECRET, NAME, SHA))
     assert 301 == response.status_code
+
+def _compressed(s, compress, workers=1):
+    """
+    Compress `s` as `blueprint-create`(1) would and return the SHA1 sum of
+    the result and the result itself.  `s` is written in pieces smaller
+    than a block, as `tarfile` writes it.
+    """
+    with context_managers.mkdtemp():
+        f = sources._Compressor(sources._SHA1File(open('tarball', 'wb')),
+                                compress,
+                                workers)
+        for i in xrange(0, len(s), 10240):
+            f.write(s[i:i + 10240])
+        f.close()
+        return f.hexdigest(), open('tarball').read()
+
+def _PUT_tarball_compressed(extension, content_type, compress):
+    sha, data = _compressed(open(pathname).read(), compress)
+    response = c.put('/{0}/{1}'.format(SECRET, NAME),
+                     content_type='application/json',
+                     data=json.dumps({
+                         'sources': {
+                             '/usr/local': '{0}.{1}'.format(sha, extension),
+                         },
+                     }))
+    assert 202 == response.status_code
+    response = c.put('/{0}/{1}/{2}.{3}'.format(SECRET, NAME, sha, extension),
+                     content_type=content_type,
+                     data=data)
+    assert 202 == response.status_code
+    return sha
+
+def test_PUT_tarball_gz():
+    _PUT_tarball_compressed('tar.gz', 'application/x-gzip', sources._gzip)
+
+def test_PUT_tarball_bz2():
+    _PUT_tarball_compressed('tar.bz2', 'application/x-bzip2', bz2.compress)
+
+def test_PUT_tarball_bz2_mismatch():
+    sha = _PUT_tarball_compressed('tar.gz',
+                                  'application/x-gzip',
+                                  sources._gzip)
+    response = c.put('/{0}/{1}/{2}.tar.bz2'.format(SECRET, NAME, sha),
+                     content_type='application/x-bzip2',
+                     data=_compressed(open(pathname).read(),
+                                      sources._gzip)[1])
+    assert 400 == response.status_code
+
+def test_GET_tarball_gz():
+    sha = _PUT_tarball_compressed('tar.gz',
+                                  'application/x-gzip',
+                                  sources._gzip)
+    response = c.get('/{0}/{1}/{2}.tar.gz'.format(SECRET, NAME, sha))
+    assert 301 == response.status_code
+
+def test_GET_tarball_bz2():
+    sha = _PUT_tarball_compressed('tar.bz2',
+                                  'application/x-bzip2',
+                                  bz2.compress)
+    response = c.get('/{0}/{1}/{2}.tar.bz2'.format(SECRET, NAME, sha))
+    assert 301 == response.status_code
+
+def test_PUT_blueprint_deletes_tarball_gz():
+    sha = _PUT_tarball_compressed('tar.gz',
+                                  'application/x-gzip',
+                                  sources._gzip)
+    test_PUT_blueprint_empty()
+    response = c.get('/{0}/{1}/{2}.tar.gz'.format(SECRET, NAME, sha))
+    assert 404 == response.status_code
+
+def test_PUT_blueprint_deletes_tarball_bz2():
+    sha = _PUT_tarball_compressed('tar.bz2',
+                                  'application/x-bzip2',
+                                  bz2.compress)
+    test_PUT_blueprint_empty()
+    response = c.get('/{0}/{1}/{2}.tar.bz2'.format(SECRET, NAME, sha))
+    assert 404 == response.status_code
+
+def test_tar_compression():
+    for filename, option in (('a.tar', ''),
+                             ('a.tar.gz', 'z'),
+                             ('a.tgz', 'z'),
+                             ('a.tar.bz2', 'j'),
+                             ('a.tbz2', 'j'),
+                             ('a.gz', ''),
+                             ('a.tar.xz', '')):
+        assert option == util.tar_compression(filename), filename
+
+def test_Compressor():
+    s = ''.join([str(i) for i in xrange(3 * sources.BLOCK_SIZE // 5)])
+    assert 2 * sources.BLOCK_SIZE < len(s)
+    for compress, command in ((sources._gzip, 'gzip'),
+                              (bz2.compress, 'bzip2')):
+        expected = None
+        for workers in (1, 4):
+            sha, data = _compressed(s, compress, workers)
+            assert hashlib.sha1(data).hexdigest() == sha
+            assert expected in (None, data), (command, workers)
+            expected = data
+            returncode, stdout, stderr = processes.run([command, '-dc'],
+                                                       data,
+                                                       stdin=processes.PIPE,
+                                                       stdout=processes.PIPE)
+            assert 0 == returncode, (command, workers)
+            assert s == stdout, (command, workers)
+
+# A small tree to match pathname rules against.  Rules with a slash were
+# matched with `glob`(3) before they were compiled, so the tree must exist.
+TREE = ('a/',
+        'a/.hidden',
+        'a/b.conf',
+        'a/c~',
+        'a/d/',
+        'a/d/e.conf',
+        'f/',
+        'f/g.conf',
+        'f/h.dpkg-old',
+        'f/[x]',
+        'i.conf')
+
+# Rule sets to compare the compiled matcher against the original loop.
+# `{0}` is the root of the tree, making a rule anchored.
+PATHNAME_RULES = ([('*~', False)],
+                  [('*.conf', False), ('b.conf', True)],
+                  [('{0}/a', False), ('{0}/a/d/e.conf', True)],
+                  [('{0}/a', True), ('{0}', False)],
+                  [('{0}', False), ('{0}/a', True), ('*.conf', False)],
+                  [('a', False)],
+                  [('a/', False), ('d/', True)],
+                  [('a/*', False), ('a/d/', True)],
+                  [('{0}/*/d', False), ('*.conf', True), ('e.conf', False)],
+                  [('{0}/a/*', False)],
+                  [('{0}/a/.*', False), ('{0}/f/[gh]*', False)],
+                  [('{0}/f/[!g]*', False), ('[[]x]', True)],
+                  [('{0}/*', False), ('{0}/f/*.conf', True)],
+                  [('{0}/a/d/e.conf', True), ('{0}/a', False)])
+
+def _tree():
+    dirname = tempfile.mkdtemp()
+    for rel in TREE:
+        pathname = os.path.join(dirname, rel)
+        if '/' == rel[-1]:
+            os.mkdir(pathname)
+        else:
+            open(pathname, 'w').close()
+    pathnames = [dirname] + [os.path.join(dirname, rel.rstrip('/'))
+                             for rel in TREE]
+    return dirname, pathnames
+
+def _ignore_pathname(rule_set, dirname, pathname, ignored=False):
+    """
+    The original `fnmatch` and `glob` loop that `PathnameMatcher` replaced.
+    """
+    pathname = util.unicodeme(pathname)
+    filename = os.path.basename(pathname)
+    for pattern, negate in rule_set:
+        if ignored != negate:
+            continue
+        dir_only = '/' == pattern[-1]
+        pattern = pattern.rstrip('/')
+        matched = False
+        if '/' not in pattern:
+            matched = fnmatch.fnmatch(filename, pattern)
+        else:
+            for p in glob.glob(os.path.join(dirname, pattern)):
+                p = util.unicodeme(p)
+                if pathname == p or pathname.startswith('{0}/'.format(p)):
+                    matched = True
+        if matched and (not dir_only or os.path.isdir(pathname)):
+            ignored = not ignored
+    return ignored
+
+def _pathname_rule_sets(dirname):
+    for rule_set in PATHNAME_RULES:
+        yield [(pattern.format(dirname), negate)
+               for pattern, negate in rule_set]
+
+def test_PathnameMatcher():
+    dirname, pathnames = _tree()
+    try:
+        for rule_set in _pathname_rule_sets(dirname):
+            matcher = rules.PathnameMatcher(rule_set, dirname)
+            for pathname in pathnames:
+                for ignored in (False, True):
+                    assert _ignore_pathname(rule_set,
+                                            dirname,
+                                            pathname,
+                                            ignored) \
+                        == matcher.ignore(pathname, ignored), \
+                        (rule_set, pathname, ignored)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_PathnameMatcher_state():
+    dirname, pathnames = _tree()
+    try:
+        for rule_set in _pathname_rule_sets(dirname):
+            matcher = rules.PathnameMatcher(rule_set, dirname)
+            state = marshal.loads(marshal.dumps(matcher.state()))
+            loaded = rules.PathnameMatcher.from_state(state)
+            for pathname in pathnames:
+                assert matcher.ignore(pathname) == loaded.ignore(pathname)
+                assert matcher.ignore_tree(pathname) \
+                    == loaded.ignore_tree(pathname)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_PathnameMatcher_ignore_tree():
+    dirname, pathnames = _tree()
+    try:
+        for rule_set in _pathname_rule_sets(dirname):
+            matcher = rules.PathnameMatcher(rule_set, dirname)
+            for tree in pathnames:
+                if not matcher.ignore_tree(tree):
+                    continue
+                for pathname in pathnames:
+                    if pathname != tree \
+                    and not pathname.startswith(tree + '/'):
+                        continue
+                    for ignored in (False, True):
+                        assert _ignore_pathname(rule_set,
+                                                dirname,
+                                                pathname,
+                                                ignored), \
+                            (rule_set, tree, pathname, ignored)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_PathnameMatcher_ignore_tree_negated():
+    dirname, pathnames = _tree()
+    try:
+        a = os.path.join(dirname, 'a')
+        assert rules.PathnameMatcher([(a, False)], dirname).ignore_tree(a)
+        for rule_set in ([(a, False), (a + '/d/e.conf', True)],
+                         [(a, False), ('e.conf', True)],
+                         [(a, False), ('a/d/*', True)],
+                         [(a, False), (dirname + '/*', True)],
+                         [(a, False), (a, True)],
+                         [('a', False)],
+                         [('a/', False)]):
+            matcher = rules.PathnameMatcher(rule_set, dirname)
+            assert not matcher.ignore_tree(a), rule_set
+        matcher = rules.PathnameMatcher([(a, True), (a, False)], dirname)
+        assert matcher.ignore_tree(a)
+    finally:
+        shutil.rmtree(dirname)
+
+# Rule sets to compare the package and service index against the original
+# loop, each with the resources to look up.
+RESOURCE_RULES = ([('apt', 'libc6', False)],
+                  [('apt', '*', False), ('apt', 'ruby', True)],
+                  [('*', 'ruby', False), ('apt', '*', True)],
+                  [('*', '*', False), ('yum', 'ruby', True),
+                   ('yum', '*', False)],
+                  [('apt', 'ruby', True), ('apt', 'ruby', False),
+                   ('*', 'ruby', True)])
+RESOURCES = (('apt', 'libc6'),
+             ('apt', 'ruby'),
+             ('yum', 'ruby'),
+             ('yum', 'libc6'),
+             ('sysvinit', 'ssh'))
+
+def _ignore_resource(rule_set, manager, name, ignored=False):
+    """
+    The original loop that `ResourceIndex` replaced.
+    """
+    for m, n, negate in rule_set:
+        if ignored != negate \
+        or manager != m and '*' != m \
+        or name != n and '*' != n:
+            continue
+        ignored = not ignored
+    return ignored
+
+def test_ResourceIndex():
+    for rule_set in RESOURCE_RULES:
+        index = rules.ResourceIndex(rule_set)
+        loaded = rules.ResourceIndex.from_state(
+            marshal.loads(marshal.dumps(index.state())))
+        for manager, name in RESOURCES:
+            for ignored in (False, True):
+                expected = _ignore_resource(rule_set, manager, name, ignored)
+                assert expected == index.ignore(manager, name, ignored), \
+                    (rule_set, manager, name, ignored)
+                assert expected == loaded.ignore(manager, name, ignored)
+
+def _sethome(home):
+    """
+    Point `HOME`, where `blueprint.cache` keeps its caches, at `home` and
+    return where it pointed before.  `None` unsets it.
+    """
+    old = os.environ.get('HOME')
+    if home is None:
+        del os.environ['HOME']
+    else:
+        os.environ['HOME'] = home
+    return old
+
+def test_cache_untrusted():
+    home = _sethome(tempfile.mkdtemp())
+    try:
+        cache.dump('test', 'key', 'value')
+        assert 'value' == cache.load('test', 'key')
+        dirname = os.path.join(os.environ['HOME'], '.blueprint-cache')
+        os.chmod(dirname, 0777)
+        assert cache.load('test', 'key') is None
+        os.chmod(dirname, 0700)
+        os.rename(dirname, dirname + '.real')
+        os.symlink(dirname + '.real', dirname)
+        assert cache.load('test', 'key') is None
+    finally:
+        shutil.rmtree(_sethome(home))
+
+def test_dpkg_multiarch():
+    info = dpkg.INFO
+    with context_managers.mkdtemp() as c:
+        home, dpkg.INFO = _sethome(c.tempdir), c.tempdir
+        try:
+            for name, content in (
+                ('libc6:amd64.list', '/lib\n/lib/a.so\n'),
+                ('libc6:i386.list', '/lib\n/lib32/a.so\n'),
+                ('libc6:amd64.md5sums', '{0}  lib/a.so\n'.format('0' * 32)),
+                ('ruby.list', '/usr/bin/ruby\n')):
+                open(name, 'w').write(content)
+            for f in (dpkg._index, dpkg.md5sums):
+                if hasattr(f, '_cache'):
+                    del f._cache
+            assert ['/lib', '/lib/a.so', '/lib32/a.so'] == dpkg.files('libc6')
+            assert ['/usr/bin/ruby'] == dpkg.files('ruby')
+            assert ['libc6'] == dpkg.packages('/lib32/a.so')
+            assert {'/lib/a.so': '0' * 32} == dpkg.md5sums('libc6')
+        finally:
+            dpkg.INFO = info
+            for f in (dpkg._index, dpkg.md5sums):
+                if hasattr(f, '_cache'):
+                    del f._cache
+            _sethome(home)
+
+def _finishes(f):
+    t = threading.Thread(target=f)
+    t.daemon = True
+    t.start()
+    t.join(10)
+    return not t.is_alive()
+
+def _pipe():
+    p = processes.popen(['echo', 'foo'], stdout=processes.PIPE)
+    returncode, stdout, stderr = processes.run(['cat'],
+                                               stdin=p.stdout,
+                                               stdout=processes.PIPE)
+    p.stdout.close()
+    assert 'foo\n' == stdout
+
+def _raise():
+    try:
+        with processes.popen(['yes'],
+                             stdout=processes.PIPE,
+                             stderr=processes.PIPE) as p:
+            p.stdout.readline()
+            raise ValueError
+    except ValueError:
+        pass
+
+def _abandon():
+    processes.popen(['yes'],
+                    stdout=processes.PIPE,
+                    stderr=processes.PIPE).stdout.readline()
+
+def test_processes_limit():
+    semaphore = getattr(processes._semaphore, '_cache', None)
+    processes._semaphore._cache = threading.BoundedSemaphore(1)
+    try:
+
+        # Both ends of a pipe run on one thread within a limit of one.
+        assert _finishes(_pipe)
+        assert _finishes(_pipe)
+
+        # Slots are given up by callers that raise or stop reading early.
+        for f in (_raise, _abandon):
+            assert _finishes(f)
+            assert _finishes(lambda: processes.run(['true']))
+
+    finally:
+        if semaphore is None:
+            del processes._semaphore._cache
+        else:
+            processes._semaphore._cache = semaphore
+
+def _resources(dirname='/etc'):
+    """
+    Return the calls that add three sets of resources to a blueprint, whose
+    files, packages, services, and sources overlap as the backends' might.
+    """
+    return (
+        (('add_file', os.path.join(dirname, 'a.conf'),
+          {'content': 'a', 'encoding': 'plain'}),
+         ('add_file', os.path.join(dirname, 'b.conf'),
+          {'content': 'b', 'encoding': 'plain'}),
+         ('add_package', 'apt', 'libc6', '2.13'),
+         ('add_package', 'apt', 'ruby', '1.8'),
+         ('add_service', 'stub', 'ssh'),
+         ('add_service_file', 'stub', 'ssh', os.path.join(dirname, 'a.conf')),
+         ('add_service_package', 'stub', 'ssh', 'pip', 'libc6'),
+         ('add_source', '/usr/local', '0' * 40 + '.tar')),
+        (('add_file', os.path.join(dirname, 'b.conf'),
+          {'content': 'B', 'encoding': 'plain', 'mode': '100600'}),
+         ('add_package', 'apt', 'libc6', '2.14'),
+         ('add_package', 'gem', 'rails', '3.0'),
+         ('add_service', 'stub', 'ssh'),
+         ('add_service_file', 'stub', 'ssh', os.path.join(dirname, 'b.conf')),
+         ('add_service_package', 'stub', 'ssh', 'pip', 'ruby', 'rails'),
+         ('add_service_source', 'stub', 'ssh', '/usr/local'),
+         ('add_service', 'stub', 'cron'),
+         ('add_source', '/opt', '1' * 40 + '.tar'),
+         ('arch', 'amd64')),
+        (('add_package', 'apt', 'ruby', '1.8'),
+         ('add_service', 'stub', 'cron'),
+         ('add_service_source', 'stub', 'cron', '/opt'),
+         ('add_source', '/usr/local', '2' * 40 + '.tar'),
+         ('arch', 'i386')))
+
+def _apply(b, calls):
+    for call in calls:
+        if 'arch' == call[0]:
+            b.arch = call[1]
+        elif 'add_file' == call[0]:
+            b.add_file(call[1], **call[2])
+        else:
+            getattr(b, call[0])(*call[1:])
+
+def test_Blueprint_merge():
+    merged, expected = blueprint.Blueprint(), blueprint.Blueprint()
+    for calls in _resources():
+        b = blueprint.Blueprint()
+        _apply(b, calls)
+        merged._merge(b)
+        _apply(expected, calls)
+    assert expected.dumps() == merged.dumps()
+    assert 'B' == merged.files['/etc/b.conf']['content']
+    assert set(['2.13', '2.14']) == merged.packages['apt']['libc6']
+    assert '2' * 40 + '.tar' == merged.sources['/usr/local']
+    assert 'i386' == merged.arch
+
+def test_Blueprint_create_workers():
+
+    # Backends finish in whatever order they like but are merged in the
+    # order of `backend.__all__`, so any number of workers gives the same
+    # blueprint.  The first backend finishes last.
+    workers = blueprint.cfg.get('create', 'workers')
+    names = blueprint.backend.__all__
+    with context_managers.mkdtemp() as c:
+
+        # The files the services depend on name one another, so the search
+        # for service dependencies finds more.
+        for name in ('a.conf', 'b.conf'):
+            open(name, 'w').write(os.path.join(c.tempdir, 'a.conf'))
+
+        resources = _resources(c.tempdir)
+        stubs = []
+        for i, calls in enumerate(resources):
+            def stub(b, r, calls=calls, delay=0.1 * (len(resources) - i)):
+                time.sleep(delay)
+                _apply(b, calls)
+            stubs.append('stub{0}'.format(i))
+            setattr(blueprint.backend, stubs[-1], stub)
+        try:
+            blueprint.backend.__all__ = stubs
+            dumps = []
+            for n in ('1', '4'):
+                blueprint.cfg.set('create', 'workers', n)
+                dumps.append(blueprint.Blueprint.rules(rules.none()).dumps())
+        finally:
+            blueprint.backend.__all__ = names
+            blueprint.cfg.set('create', 'workers', workers)
+            for name in stubs:
+                delattr(blueprint.backend, name)
+
+        expected = blueprint.Blueprint()
+        for calls in resources:
+            _apply(expected, calls)
+    assert expected.dumps() == dumps[0] == dumps[1]
+
+def _source_tree(dirname):
+    """
+    Build a tree to archive in `dirname`, with a hard link, a symbolic
+    link, and files the sources backend excludes.
+    """
+    site_packages = os.path.join(dirname, 'lib/python2.7/site-packages')
+    os.makedirs(os.path.join(site_packages, 'foo-1.0.egg-info'))
+    os.makedirs(os.path.join(dirname, 'd'))
+    os.makedirs(os.path.join(dirname, 'empty'))
+    for rel, content in (('a', 'a' * 1000),
+                         ('d/b', 'b'),
+                         ('e.o', 'ignored'),
+                         ('lib/python2.7/site-packages/easy-install.pth', ''),
+                         ('lib/python2.7/site-packages/foo.py', ''),
+                         ('lib/python2.7/site-packages/'
+                          'foo-1.0.egg-info/installed-files.txt',
+                          '../foo.py\n')):
+        open(os.path.join(dirname, rel), 'w').write(content)
+    os.link(os.path.join(dirname, 'd/b'), os.path.join(dirname, 'd/c'))
+    os.symlink('a', os.path.join(dirname, 'l'))
+    os.symlink('missing', os.path.join(dirname, 'dangling'))
+
+def _source_rules(dirname):
+    return rules.Rules({'file': [],
+                        'source': [('/', False),
+                                   (dirname, True),
+                                   ('*.o', False)]})
+
+def test_source():
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            dirname = os.path.join(c.tempdir, 'src')
+            _source_tree(dirname)
+            tarname = sources._source(blueprint.Blueprint(),
+                                      _source_rules(dirname),
+                                      dirname)
+        finally:
+            _sethome(home)
+        assert hashlib.sha1(open(tarname).read()).hexdigest() + '.tar' \
+            == tarname
+        assert [tarname] == glob.glob('*.tar*')
+        tar = tarfile.open(tarname)
+        assert ['.', './a', './d', './d/b', './d/c', './l'] == tar.getnames()
+        assert 'a' * 1000 == tar.extractfile('./a').read()
+        assert tar.getmember('./d/b').isfile()
+        assert tar.getmember('./d/c').islnk()
+        assert './d/b' == tar.getmember('./d/c').linkname
+        assert tar.getmember('./l').issym()
+        assert 'a' == tar.getmember('./l').linkname
+
+def test_source_raises():
+    add = sources._add
+    def _add(*args):
+        raise UnicodeDecodeError('ascii', '', 0, 1, 'stub')
+    sources._add = _add
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            dirname = os.path.join(c.tempdir, 'src')
+            _source_tree(dirname)
+            try:
+                sources._source(blueprint.Blueprint(),
+                                _source_rules(dirname),
+                                dirname)
+            except UnicodeDecodeError:
+                pass
+            else:
+                assert False
+        finally:
+            sources._add = add
+            _sethome(home)
+        assert [] == glob.glob('tmp.*')
+
+def _source_commit(b, r, *dirnames):
+    """
+    Archive each directory, commit the tarballs to the blueprint, and
+    return each tarball's name and whether it was written rather than
+    reused.  The tarballs are removed afterward, as if the next run were
+    in another working directory.
+    """
+    tarnames = []
+    for dirname in dirnames:
+        tarname = sources._source(b, r, dirname)
+        tarnames.append((tarname, os.path.exists(tarname)))
+        b.add_source(dirname, tarname)
+    b.commit()
+    for tarname in glob.glob('*.tar*'):
+        os.unlink(tarname)
+    return tarnames
+
+def test_source_unchanged():
+    reproducible = blueprint.cfg.get('sources', 'reproducible')
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            open('.gitconfig', 'w').write('[user]\n'
+                                          '\tname = Test\n'
+                                          '\temail = test@example.com\n')
+            dirname = os.path.join(c.tempdir, 'src')
+            _source_tree(dirname)
+            r = _source_rules(dirname)
+
+            # An unchanged directory isn't archived again and its tarball
+            # is taken from the last commit.
+            [(tarname, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            assert written
+            b = blueprint.Blueprint.checkout(NAME)
+            blob = git.blob(git.tree(b._commit), tarname)
+            assert blob is not None
+            b = blueprint.Blueprint(NAME)
+            assert [(tarname, False)] == _source_commit(b, r, dirname)
+            assert blob == git.blob(git.tree(b._commit), tarname)
+            assert tarname == blueprint.Blueprint.checkout(NAME).sources[
+                dirname]
+
+            # Changing a member's modification time or size archives the
+            # directory again.
+            pathname = os.path.join(dirname, 'a')
+            s = os.stat(pathname)
+            os.utime(pathname, (s.st_atime, s.st_mtime + 10))
+            [(tarname2, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            assert written and tarname != tarname2
+            assert [(tarname2, False)] == _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            open(pathname, 'a').write('a')
+            os.utime(pathname, (s.st_atime, s.st_mtime + 10))
+            [(tarname3, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            assert written and tarname3 not in (tarname, tarname2)
+
+            # So does changing the options it's archived with.
+            blueprint.cfg.set('sources', 'reproducible', 'true')
+            [(tarname4, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            assert written and tarname4 != tarname3
+
+            # Two identical directories archive identically in reproducible
+            # mode but a tarball the blueprint names for one of them isn't
+            # reused for the other.
+            dirname2 = os.path.join(c.tempdir, 'src2')
+            _source_tree(dirname2)
+            open(os.path.join(dirname2, 'a'), 'w').write(open(pathname).read())
+            r2 = _source_rules(dirname2)
+            [(tarname5, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r2, dirname2)
+            assert written and tarname4 == tarname5
+            [(tarname6, written)] = _source_commit(
+                blueprint.Blueprint(NAME), r, dirname)
+            assert written and tarname4 == tarname6
+
+        finally:
+            blueprint.cfg.set('sources', 'reproducible', reproducible)
+            _sethome(home)
+
+def test_source_reproducible():
+    reproducible = blueprint.cfg.get('sources', 'reproducible')
+    blueprint.cfg.set('sources', 'reproducible', 'true')
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            dirname = os.path.join(c.tempdir, 'src')
+            _source_tree(dirname)
+            r = _source_rules(dirname)
+            tarname = sources._source(blueprint.Blueprint(), r, dirname)
+            data = open(tarname).read()
+            os.unlink(tarname)
+
+            # Archive it again after changing when every member was
+            # modified and, if allowed, who owns them.
+            for dirpath, dirnames, filenames in os.walk(dirname):
+                for name in [''] + dirnames + filenames:
+                    pathname = os.path.join(dirpath, name)
+                    if os.path.islink(pathname):
+                        continue
+                    os.utime(pathname, (1000000000, 1000000000))
+                    if 0 == os.geteuid():
+                        os.lchown(pathname, 1, 1)
+            assert tarname == sources._source(blueprint.Blueprint(),
+                                              r,
+                                              dirname)
+            assert data == open(tarname).read()
+
+        finally:
+            blueprint.cfg.set('sources', 'reproducible', reproducible)
+            _sethome(home)
+
+def test_fixtures():
+    path = os.environ['PATH']
+    with context_managers.mkdtemp() as c:
+        os.mkdir('bin')
+        open('bin/dpkg', 'w').write('#!/bin/sh\necho "$@"\nexit 3\n')
+        os.chmod('bin/dpkg', 0755)
+        open('status', 'w').write('Package: stub\n')
+        args = ['dpkg', '--print-architecture']
+        os.environ['PATH'] = '{0}:{1}'.format(os.path.join(c.tempdir, 'bin'),
+                                              path)
+        try:
+            fixtures.start_recording(os.path.join(c.tempdir, 'bundle'))
+            with processes.popen(args, stdout=processes.PIPE) as p:
+                assert ['--print-architecture\n'] == list(p.stdout)
+            assert 3 == p.returncode
+            assert 'Package: stub\n' == fixtures.open_fixture(
+                os.path.join(c.tempdir, 'status')).read()
+            fixtures._write()
+
+            # Replay without the command or the file.
+            os.environ['PATH'] = path
+            shutil.rmtree('bin')
+            os.unlink('status')
+            fixtures.start_replaying(os.path.join(c.tempdir, 'bundle'))
+            assert (3, '--print-architecture\n', None) \
+                == processes.run(args, stdout=processes.PIPE)
+            assert 'Package: stub\n' == fixtures.open_fixture(
+                os.path.join(c.tempdir, 'status')).read()
+
+            # Commands that weren't recorded aren't found.
+            try:
+                processes.run(['dpkg', '--version'])
+            except OSError:
+                pass
+            else:
+                assert False
+
+        finally:
+            os.environ['PATH'] = path
+            fixtures._mode, fixtures._dirname = None, None
+            fixtures._commands.clear()
+
+def _swap_caches(caches):
+    """
+    Replace what each function in `caches` has cached with the value given,
+    forgetting it if the value is `None`, and return the old values so
+    they can be put back the same way.
+    """
+    old = {}
+    for f, value in caches.iteritems():
+        old[f] = getattr(f, '_cache', None)
+        if value is not None:
+            f._cache = value
+        elif hasattr(f, '_cache'):
+            del f._cache
+    return old
+
+def test_files_rpm_size():
+    with context_managers.mkdtemp() as c:
+        pathname = os.path.join(c.tempdir, 'a.conf')
+        open(pathname, 'w').write('packaged')
+        md5sum = hashlib.md5('packaged').hexdigest()
+        caches = _swap_caches({
+            dpkg._index: ({}, {}),
+            rpm._database: ([], [('stub', pathname, md5sum, '8', '100644',
+                                  '')]),
+            rpm._index: None})
+        try:
+            s = os.lstat(pathname)
+            md5sums = files._md5sums(pathname, s)
+            assert frozenset([md5sum]) == md5sums
+            candidate = (pathname, s, None, md5sums, True, (None, None))
+            assert (None, None, None, md5sum, True) == files._read(candidate)
+
+            # A file whose size differs from the packaged version's isn't
+            # even hashed.
+            open(pathname, 'w').write('modified')
+            open(pathname, 'a').write('!')
+            s = os.lstat(pathname)
+            md5sums = files._md5sums(pathname, s)
+            assert frozenset() == md5sums
+            candidate = (pathname, s, None, md5sums, True, (None, None))
+            assert (None, None, 'modified!', None, False) \
+                == files._read(candidate)
+
+        finally:
+            _swap_caches(caches)
+
+def test_files_unchanged():
+    with context_managers.mkdtemp() as c:
+        conffile = os.path.join(c.tempdir, 'conffile')
+        override = os.path.join(c.tempdir, 'override')
+        for pathname in (conffile, override):
+            open(pathname, 'w').write('packaged')
+        md5sum = hashlib.md5('packaged').hexdigest()
+        caches = _swap_caches({
+            dpkg._index: ({'stub': [conffile]}, {conffile: set(['stub'])}),
+            dpkg.conffiles: {conffile: md5sum},
+            dpkg.md5sums: {'stub': {}},
+            rpm._database: ([], []),
+            rpm._index: None})
+        files.MD5SUMS[override] = [md5sum]
+        try:
+            for pathname in (conffile, override):
+                s = os.lstat(pathname)
+                md5sums = files._md5sums(pathname, s)
+                assert frozenset([md5sum]) == md5sums, pathname
+                candidate = (pathname, s, None, md5sums, True, (None, None))
+                assert files._read(candidate)[4], pathname
+
+                # Once modified, the same file is included.
+                open(pathname, 'w').write('modified')
+                assert (None, None, 'modified', hashlib.md5(
+                    'modified').hexdigest(), False) \
+                    == files._read(candidate), pathname
+
+        finally:
+            del files.MD5SUMS[override]
+            _swap_caches(caches)
+
+def test_files_overrides():
+    with context_managers.mkdtemp() as c:
+        pathname = os.path.join(c.tempdir, 'a.conf')
+        reference = os.path.join(c.tempdir, 'reference')
+        open(reference, 'w').write('packaged')
+        files.MD5SUMS[pathname] = ['0' * 32,
+                                   reference,
+                                   os.path.join(c.tempdir, 'missing')]
+        try:
+
+            # Pathnames are hashed the first time they're looked up and
+            # those that can't be read are left out.
+            expected = frozenset(['0' * 32,
+                                  hashlib.md5('packaged').hexdigest()])
+            assert expected == files._overrides(pathname)
+            os.unlink(reference)
+            assert expected == files._overrides(pathname)
+
+        finally:
+            del files.MD5SUMS[pathname]
+
+def test_files_templates():
+    with context_managers.mkdtemp() as c:
+        pathname = os.path.join(c.tempdir, 'a.conf')
+        open(pathname, 'w').write('rendered')
+        open(pathname + '.blueprint-template.mustache', 'w').write('{{x}}')
+        open(pathname + '.blueprint-template.sh', 'w').write('x=rendered')
+        names = set(os.listdir(c.tempdir))
+        templates = files._templates(pathname, names)
+        assert (pathname + '.blueprint-template.mustache',
+                pathname + '.blueprint-template.sh') == templates
+        assert (pathname + '.blueprint-template.mustache', None) \
+            == files._templates(pathname, names - set([
+                'a.conf.blueprint-template.sh']))
+        assert (None, None) == files._templates(
+            os.path.join(c.tempdir, 'b.conf'), names)
+
+        # A templated file is still hashed to see if it's packaged but its
+        # content isn't kept.
+        s = os.lstat(pathname)
+        md5sums = frozenset(['0' * 32])
+        assert ('{{x}}', 'x=rendered', None,
+                hashlib.md5('rendered').hexdigest(), False) \
+            == files._read((pathname, s, None, md5sums, False, templates))
+
+def test_files_cached():
+    with context_managers.mkdtemp() as c:
+        pathname = os.path.join(c.tempdir, 'a.conf')
+        open(pathname, 'w').write('packaged')
+        s = os.lstat(pathname)
+        stat_key, digest = files._cached({}, pathname, s)
+        assert digest is None
+        digest = (stat_key, hashlib.md5('packaged').hexdigest(), True)
+        digests = {pathname: digest}
+        assert (stat_key, digest) == files._cached(digests, pathname, s)
+
+        # Changing only the file's change time discards its digest.
+        time.sleep(0.01)
+        os.chmod(pathname, 0600)
+        os.chmod(pathname, stat.S_IMODE(s.st_mode))
+        s = os.lstat(pathname)
+        assert files._cached(digests, pathname, s)[1] is None
+
+        # Only regular files are cached.
+        os.symlink('a.conf', 'b.conf')
+        assert (None, None) == files._cached(digests,
+                                             pathname,
+                                             os.lstat('b.conf'))
+
+# What `rpm -qa` prints for two packages in `rpm.QUERYFORMAT`, followed by
+# one whose line is missing fields.
+RPM_DUMP = ('\x1Dbash\x1ESystem Environment/Shells\x1E(none)\x1E4.1.2-15.el6'
+            '\x1Ex86_64\x1Ebash\x1Fconfig(bash)\x1F'
+            '\x1E/bin/sh\x1Flibc.so.6\x1Frpmlib(CompressedFileNames)\x1F\n'
+            '/bin/bash\x1E' + '1' * 32 + '\x1E903336\x1E100755\x1E\n'
+            '/bin/sh\x1E\x1E4\x1E120777\x1Ebash\n'
+            '/etc/skel/.bashrc\x1E' + '2' * 32 + '\x1E124\x1E100644\x1E\n'
+            '\x1Dglibc\x1ESystem Environment/Libraries\x1E(none)'
+            '\x1E2.12-1.47.el6\x1Ex86_64\x1Eglibc\x1Flibc.so.6\x1F\x1E\n'
+            '/lib64/libc.so.6\x1E' + '3' * 32 + '\x1E100\x1E100755\x1E\n'
+            '\x1Dbroken\x1E(none)\n'
+            '/broken\x1E' + '4' * 32 + '\x1E1\x1E100644\x1E\n')
+
+def test_rpm():
+    caches = _swap_caches({rpm._database: rpm._parse(
+                               RPM_DUMP.splitlines(True)),
+                           rpm._index: None,
+                           rpm.depends: None})
+    try:
+        assert [('bash',
+                 'System Environment/Shells',
+                 '(none)',
+                 '4.1.2-15.el6',
+                 'x86_64'),
+                ('glibc',
+                 'System Environment/Libraries',
+                 '(none)',
+                 '2.12-1.47.el6',
+                 'x86_64')] == rpm.installed()
+        assert ['/bin/bash', '/bin/sh', '/etc/skel/.bashrc'] \
+            == rpm.files('bash')
+        assert [] == rpm.files('broken')
+        assert ['bash'] == rpm.packages('/bin/sh')
+        assert [] == rpm.packages('/broken')
+
+        # Symbolic links have the digest and size of their target.
+        assert '1' * 32 == rpm.digest('/bin/bash') == rpm.digest('/bin/sh')
+        assert '2' * 32 == rpm.digest('/etc/skel/.bashrc')
+        assert rpm.digest('/broken') is None
+        assert 903336 == rpm.size('/bin/sh')
+        assert 124 == rpm.size('/etc/skel/.bashrc')
+        assert rpm.size('/broken') is None
+
+        # Files aren't capabilities but are provided by their owner.
+        assert 'glibc' == rpm.whatprovides('libc.so.6')
+        assert 'bash' == rpm.whatprovides('/bin/sh')
+        assert rpm.whatprovides('libc.so.5') is None
+        assert frozenset(['bash', 'glibc']) == rpm.depends('bash')
+
+    finally:
+        _swap_caches(caches)
+
+def _stat(entry, follow_symlinks):
+    try:
+        return tuple(entry.stat(follow_symlinks=follow_symlinks))
+    except OSError:
+        return None
+
+def _fs_walk(top):
+    """
+    Walk a tree with `fs.walk` and return everything each entry says about
+    itself, in a stable order.
+    """
+    def entries(l):
+        return sorted([(entry.name,
+                        entry.path,
+                        entry.is_dir(),
+                        entry.is_symlink(),
+                        _stat(entry, False),
+                        _stat(entry, True)) for entry in l])
+    return sorted([(dirpath, entries(dirs), entries(files))
+                   for dirpath, dirs, files in fs.walk(top)])
+
+def test_fs_walk():
+    scandir = fs.scandir
+    with context_managers.mkdtemp() as c:
+        os.makedirs('a/c')
+        open('a/b', 'w').close()
+        open('a/c/d', 'w').close()
+        os.symlink('a', 'l')
+        os.symlink('a/b', 'm')
+        os.symlink('missing', 'dangling')
+        try:
+            fs.scandir = None
+            walked = _fs_walk(c.tempdir)
+            if scandir is not None:
+                fs.scandir = scandir
+                assert walked == _fs_walk(c.tempdir)
+        finally:
+            fs.scandir = scandir
+
+        # Symbolic links to directories are listed with directories but not
+        # walked, as with `os.walk`.
+        assert [(dirpath, sorted(dirnames), sorted(filenames))
+                for dirpath, dirnames, filenames
+                in sorted(os.walk(c.tempdir))] \
+            == [(dirpath,
+                 [entry[0] for entry in dirs],
+                 [entry[0] for entry in files])
+                for dirpath, dirs, files in walked]
+        [(dirpath, dirs, files)] = [t for t in walked if c.tempdir == t[0]]
+        assert [('a', True, False), ('l', True, True)] \
+            == [(entry[0], entry[2], entry[3]) for entry in dirs]
+        assert tuple(os.lstat('l')) == dirs[1][4]
+        assert tuple(os.stat('l')) == dirs[1][5]
+        assert ('dangling', False, True, None) \
+            == (files[0][0], files[0][2], files[0][3], files[0][5])
+
+def test_processes_release():
+    semaphore = getattr(processes._semaphore, '_cache', None)
+    processes._semaphore._cache = threading.BoundedSemaphore(1)
+    try:
+
+        # Slots are given up as soon as a child process is waited for, not
+        # when it's garbage.
+        for f in (lambda p: p.wait(),
+                  lambda p: p.communicate(),
+                  lambda p: p.stdout.close(),
+                  lambda p: p.stdout.read() and p.stdout.read()):
+            p = processes.popen(['echo', 'foo'], stdout=processes.PIPE)
+            f(p)
+            assert processes._semaphore._cache.acquire(False)
+            processes._semaphore._cache.release()
+            assert p._child.reaped
+            p.stdout.close()
+
+    finally:
+        if semaphore is None:
+            del processes._semaphore._cache
+        else:
+            processes._semaphore._cache = semaphore
+
+def test_deps_walk():
+    graph = {'a': ['b'], 'b': ['c'], 'c': ['b', 'd'], 'd': [], 'e': ['c']}
+    walked = []
+    def depends(package):
+        walked.append(package)
+        return frozenset(graph[package])
+    saved = dict(deps.apt.__dict__)
+    deps.apt.__dict__.clear()
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            assert set('abcd') == deps._walk(deps.apt,
+                                             'a',
+                                             depends,
+                                             'test',
+                                             'key')
+            assert ['a', 'b', 'c', 'd'] == sorted(walked)
+
+            # Closures are remembered per package, so later walks through
+            # a package reuse its closure, and only cached on disk when
+            # asked.
+            assert set('bcd') == deps._walk(deps.apt,
+                                            'c',
+                                            depends,
+                                            'test',
+                                            'key')
+            del walked[:]
+            assert set('abcde') == deps._walk(deps.apt,
+                                              set(['a', 'e']),
+                                              depends,
+                                              'test',
+                                              'key')
+            assert ['e'] == walked
+            assert cache.load('test', 'key') is None
+            deps.dump()
+            assert set('bcd') == cache.load('test', 'key')['c']
+
+        finally:
+            _sethome(home)
+            deps.apt.__dict__.clear()
+            deps.apt.__dict__.update(saved)
+
+def test_source_unwritable():
+    with context_managers.mkdtemp() as c:
+        home = _sethome(c.tempdir)
+        try:
+            dirname = os.path.join(c.tempdir, 'src')
+            _source_tree(dirname)
+
+            # A working directory that's been removed can't be written to,
+            # even by root.
+            os.mkdir('gone')
+            with context_managers.cd('gone'):
+                os.rmdir(os.path.join(c.tempdir, 'gone'))
+                assert sources._source(blueprint.Blueprint(),
+                                       _source_rules(dirname),
+                                       dirname) is None
+        finally:
+            _sethome(home)